@@ -31,6 +31,14 @@ class xdg(object):
     if not os.path.isabs(xdg_config_home):
         xdg_config_home = os.path.join(os.path.expanduser("~"), ".config")
 
+    xdg_cache_home = os.environ.get("XDG_CACHE_HOME") or ""
+    if not os.path.isabs(xdg_cache_home):
+        xdg_cache_home = os.path.join(os.path.expanduser("~"), ".cache")
+
+    xdg_state_home = os.environ.get("XDG_STATE_HOME") or ""
+    if not os.path.isabs(xdg_state_home):
+        xdg_state_home = os.path.join(os.path.expanduser("~"), ".local", "state")
+
     xdg_config_dirs = os.environ.get("XDG_CONFIG_DIRS") or "/etc/xdg"
     xdg_config_dirs = [xdg_config_home] + list(
         filter(os.path.abspath, xdg_config_dirs.split(os.path.pathsep))
@@ -46,6 +54,26 @@ class xdg(object):
                 raise
         return path
 
+    @classmethod
+    def save_cache_path(xdg, resource):
+        path = os.path.join(xdg.xdg_cache_home, resource)
+        try:
+            os.makedirs(path, 0o700)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+        return path
+
+    @classmethod
+    def save_state_path(xdg, resource):
+        path = os.path.join(xdg.xdg_state_home, resource)
+        try:
+            os.makedirs(path, 0o700)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+        return path
+
     @classmethod
     def load_config_paths(xdg, resource):
         for config_dir in xdg.xdg_config_dirs:
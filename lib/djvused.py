@@ -13,8 +13,17 @@
 # FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
 # more details.
 
+import codecs
+import collections
+import concurrent.futures
+import itertools
 import os.path
+import re
+import selectors
+import shutil
+import tempfile
 import threading
+from queue import Queue
 
 from djvu.sexpr import Expression, Symbol
 
@@ -59,14 +68,159 @@ class IOError(IOError):
     pass
 
 
-class StreamEditor(object):
-    def __init__(self, file_name, autosave=False):
+class Session(object):
+    """
+    A long-lived djvused process serving read-only queries.
+
+    Batches of commands are framed by the ``n`` command: its output (the
+    number of pages) is a bare integer, which cannot be produced by any of
+    the ``print-*`` and ``output-*`` commands. The process is (re)started
+    on demand, so a session survives djvused dying on a bad command.
+
+    Commands are written in a separate thread, and the error output is
+    drained continuously, so that djvused never blocks on a full pipe.
+    """
+
+    def __init__(self, file_name):
         self._file_name = file_name
-        self._commands = []
+        self._process = None
+        self._sentinel = None
+        self._stderr = []
+        self._stderr_thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self._process = process = ipc.Subprocess(
+            [djvused_path, self._file_name],
+            stdin=ipc.PIPE,
+            stdout=ipc.PIPE,
+            stderr=ipc.PIPE,
+        )
+        self._stderr = stderr = []
+
+        def read_stderr():
+            size = 0
+            for data in iter(lambda: process.stderr.read1(_CHUNK_SIZE), b""):
+                if size < _STDERR_LIMIT:
+                    stderr.append(data)
+                    size += len(data)
+
+        self._stderr_thread = threading.Thread(
+            target=read_stderr, name="djvused-stderr"
+        )
+        self._stderr_thread.daemon = True
+        self._stderr_thread.start()
+        self._sentinel = None
+        self._sentinel = "".join(self._communicate(()))
+
+    def _communicate(self, commands):
+        process = self._process
+        write_errors = []
+
+        def write():
+            try:
+                for chunk in _encode_commands(itertools.chain(commands, ["n"])):
+                    process.stdin.write(chunk)
+                process.stdin.flush()
+            except (IOError, OSError) as exception:
+                # djvused died; the error output will tell why.
+                write_errors.append(exception)
+
+        writer = threading.Thread(target=write, name="djvused-stdin")
+        writer.daemon = True
+        writer.start()
+        done = False
+        try:
+            while True:
+                line = process.stdout.readline()
+                if not line:
+                    writer.join()
+                    self._fail()
+                line = line.decode("UTF-8", "replace")
+                if self._sentinel is None:
+                    done = True
+                    yield line.rstrip("\n")
+                    break
+                if line.rstrip("\n") == self._sentinel:
+                    done = True
+                    break
+                yield line
+        finally:
+            if not done and self._process is process:
+                # The batch was abandoned half-way. The rest of its output
+                # would be taken for output of the next one.
+                self._stop()
+        writer.join()
+
+    def _stop(self):
+        process = self._process
+        self._process = None
+        if process.returncode is None:
+            process.kill()
+        process.wait()
+        for fo in process.stdin, process.stdout:
+            try:
+                fo.close()
+            except (IOError, OSError):
+                pass
+        self._stderr_thread.join()
+        process.stderr.close()
+
+    def _fail(self):
+        process = self._process
+        self._process = None
+        try:
+            process.stdin.close()
+        except (IOError, OSError):
+            pass
+        process.wait()
+        self._stderr_thread.join()
+        message = b"".join(self._stderr).decode("UTF-8", "replace")
+        message = message.split("\n", 1)[0]
+        process.stdout.close()
+        process.stderr.close()
+        raise IOError(message.lstrip("* ") or "djvused died")
+
+    def execute_lines(self, commands):
+        """
+        Execute commands and yield the output line by line.
+
+        The generator must be exhausted before the session is used again.
+        """
+        with self._lock:
+            if self._process is None:
+                self._start()
+            for line in self._communicate(commands):
+                yield line
+
+    def execute(self, commands):
+        return "".join(self.execute_lines(commands))
+
+    def close(self):
+        with self._lock:
+            process = self._process
+            self._process = None
+            if process is None:
+                return
+            try:
+                process.stdin.close()
+            except (IOError, OSError):
+                pass
+            process.wait()
+            self._stderr_thread.join()
+            process.stdout.close()
+            process.stderr.close()
+
+
+class StreamEditor(object):
+    def __init__(self, file_name, autosave=False, session=None):
+        self._file_name = os.fsdecode(file_name)
+        self._commands = collections.deque()
         self._autosave = autosave
+        self._session = session
 
     def clone(self):
-        return StreamEditor(self._filename, self._autosave)
+        return StreamEditor(self._file_name, self._autosave, self._session)
 
     def _add(self, *commands):
         for command in commands:
@@ -74,6 +228,13 @@ class StreamEditor(object):
                 raise TypeError
         self._commands += commands
 
+    def _add_lazy(self, items):
+        """
+        Add commands that will be converted to strings only when they are sent
+        to djvused.
+        """
+        self._commands.append(items)
+
     def select_all(self):
         self._add("select")
 
@@ -88,8 +249,7 @@ class StreamEditor(object):
 
     def set_annotations(self, annotations):
         self._add("set-ant")
-        for annotation in annotations:
-            self._add(str(annotation))
+        self._add_lazy(annotations)
         self._add(".")
 
     def remove_annotations(self):
@@ -112,7 +272,9 @@ class StreamEditor(object):
         if text is None:
             self.remove_text()
         else:
-            self._add("set-txt", str(text), ".")
+            self._add("set-txt")
+            self._add_lazy((text,))
+            self._add(".")
 
     def remove_text(self):
         self._add("remove-txt")
@@ -120,7 +282,9 @@ class StreamEditor(object):
     def set_outline(self, outline):
         if outline is None:
             outline = ""
-        self._add("set-outline", str(outline), ".")
+        self._add("set-outline")
+        self._add_lazy((outline,))
+        self._add(".")
 
     def set_thumbnails(self, size):
         self._add("set-thumbnails %d" % size)
@@ -146,36 +310,468 @@ class StreamEditor(object):
     def save(self):
         self._add("save")
 
-    def _reader_thread(self, fo, result):
-        result[0] = fo.read()
+    def output_all(self):
+        self._add("output-all")
+
+    def _take_commands(self):
+        commands = self._commands
+        self._commands = collections.deque()
+        return _iter_commands(commands)
 
-    def _execute(self, commands, save=False):
+    def _execute_lines(self, commands, save=False, file_name=None):
+        if file_name is None:
+            file_name = self._file_name
         args = [djvused_path]
         if save:
             args += ("-s",)
-        args += (self._file_name,)
+        args += (file_name,)
         djvused = ipc.Subprocess(args, stdin=ipc.PIPE, stdout=ipc.PIPE, stderr=ipc.PIPE)
-        result = [None]
-        reader_thread = threading.Thread(
-            target=self._reader_thread, args=(djvused.stdout, result)
-        )
-        reader_thread.setDaemon(True)
-        reader_thread.start()
-        stdin = djvused.stdin
-        for command in commands:
-            stdin.write(command + "\n")
-        stdin.close()
-        djvused.wait()
+        try:
+            if os.name == "posix":
+                engine = _select_engine
+            else:
+                engine = _threaded_engine
+            stderr = []
+            for line in engine(djvused, commands, stderr):
+                yield line
+            djvused.wait()
+        finally:
+            if djvused.returncode is None:
+                djvused.kill()
+                djvused.wait()
+            for fo in djvused.stdin, djvused.stdout, djvused.stderr:
+                fo.close()
         if djvused.returncode:
-            raise IOError(djvused.stderr.readline().lstrip("* "))
-        reader_thread.join()
-        return result[0]
+            message = b"".join(stderr).decode("UTF-8", "replace")
+            raise IOError(message.split("\n", 1)[0].lstrip("* "))
+
+    def _execute(self, commands, save=False, file_name=None):
+        return "".join(self._execute_lines(commands, save=save, file_name=file_name))
 
     def commit(self):
+        commands = self._take_commands()
+        if self._session is not None and not self._autosave:
+            return self._session.execute(commands)
+        return self._execute(commands, save=self._autosave)
+
+    def commit_lines(self):
+        commands = self._take_commands()
+        if self._session is not None and not self._autosave:
+            return self._session.execute_lines(commands)
+        return self._execute_lines(commands, save=self._autosave)
+
+    def commit_to_copy(self):
+        """
+        Apply changes to a copy of the file. Return name of the copy and
+        output of the commands.
+
+        The caller is responsible for moving the copy in place of the original
+        file, or removing it.
+        """
+        commands = self._take_commands()
+        directory, base_name = os.path.split(self._file_name)
+        fd, tmp_file_name = tempfile.mkstemp(
+            dir=directory, prefix="." + base_name + "."
+        )
         try:
-            return self._execute(self._commands, save=self._autosave)
-        finally:
-            self._commands = []
+            with open(self._file_name, "rb") as source:
+                with os.fdopen(fd, "wb") as target:
+                    shutil.copyfileobj(source, target)
+            shutil.copymode(self._file_name, tmp_file_name)
+            result = self._execute(commands, save=True, file_name=tmp_file_name)
+            fd = os.open(tmp_file_name, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except BaseException:
+            _unlink_quietly(tmp_file_name)
+            raise
+        return tmp_file_name, result
+
+    def commit_atomically(self):
+        """
+        Like commit(), but apply changes to a copy of the file, and then move
+        it in place of the original one.
+        """
+        tmp_file_name, result = self.commit_to_copy()
+        try:
+            os.rename(tmp_file_name, self._file_name)
+        except BaseException:
+            _unlink_quietly(tmp_file_name)
+            raise
+        return result
+
+    @property
+    def file_name(self):
+        return self._file_name
+
+
+def _unlink_quietly(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+class IndirectEditor(object):
+    """
+    Stream editor for indirect documents.
+
+    Commands for each page are applied to copies of the pages' component
+    files, several files at a time. Commands that affect the whole document
+    are applied to a copy of the index file at the very end. The copies are
+    moved in place of the original files only after all of them have been
+    written, so a failing djvused leaves the document untouched.
+
+    This is not atomic as a whole, though: the files are replaced one by one;
+    and djvused saves the shared annotations component (which is not a copy)
+    in place, when the index is saved.
+    """
+
+    def __init__(self, file_name, page_files, max_workers=None):
+        self._file_name = file_name
+        self._page_files = page_files
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        self._max_workers = max_workers
+        self._document = self._current = StreamEditor(file_name)
+        self._pages = collections.OrderedDict()
+
+    def clone(self):
+        return IndirectEditor(self._file_name, self._page_files, self._max_workers)
+
+    def __getattr__(self, name):
+        # set_text(), set_annotations() etc. go to the selected file.
+        return getattr(self._current, name)
+
+    def _select_document(self):
+        self._current = self._document
+        return self._document
+
+    def select_all(self):
+        self._select_document().select_all()
+
+    def select(self, page_id):
+        if not isinstance(page_id, int):
+            self._select_document().select(page_id)
+            return
+        page_no = page_id - 1
+        try:
+            sed = self._pages[page_no]
+        except LookupError:
+            sed = self._pages[page_no] = StreamEditor(self._page_files(page_no))
+            sed.select(1)
+        self._current = sed
+
+    def select_shared_annotations(self):
+        self._select_document().select_shared_annotations()
+
+    def create_shared_annotations(self):
+        self._select_document().create_shared_annotations()
+
+    def commit(self):
+        pages = list(self._pages.values())
+        document = self._document
+        self._pages = collections.OrderedDict()
+        self._document = self._current = StreamEditor(self._file_name)
+        # (copy, original) pairs:
+        replacements = []
+        try:
+            if pages:
+                max_workers = min(self._max_workers, len(pages))
+                # Threads are enough here: each of them merely waits for its own
+                # djvused process.
+                with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+                    futures = [
+                        (executor.submit(sed.commit_to_copy), sed) for sed in pages
+                    ]
+                error = None
+                for future, sed in futures:
+                    try:
+                        tmp_file_name, result = future.result()
+                    except Exception as exception:
+                        if error is None:
+                            error = exception
+                        continue
+                    replacements += [(tmp_file_name, sed.file_name)]
+                if error is not None:
+                    raise error
+            if document._commands:
+                tmp_file_name, result = document.commit_to_copy()
+                replacements += [(tmp_file_name, document.file_name)]
+        except BaseException:
+            for tmp_file_name, file_name in replacements:
+                _unlink_quietly(tmp_file_name)
+            raise
+        # The index goes last, so that it never refers to files that don't
+        # exist yet.
+        for i, (tmp_file_name, file_name) in enumerate(replacements):
+            try:
+                os.rename(tmp_file_name, file_name)
+            except BaseException:
+                for tmp_file_name, file_name in replacements[i:]:
+                    _unlink_quietly(tmp_file_name)
+                raise
+
+    # Files are replaced only after all of them have been written anyway:
+    commit_atomically = commit
+
+
+def _iter_commands(commands):
+    # Consume the queue as we go, so that each command can be freed as soon as
+    # it has been sent.
+    while commands:
+        item = commands.popleft()
+        if isinstance(item, str):
+            yield item
+        else:
+            for subitem in item:
+                yield str(subitem)
+
+
+# Amount of data to pass to the pipes at once:
+_CHUNK_SIZE = 1 << 16
+
+# Only the first line of the error output is reported, so there's no point
+# keeping more than this:
+_STDERR_LIMIT = 1 << 12
+
+
+def _encode_commands(commands):
+    """
+    Group commands into chunks of roughly `_CHUNK_SIZE` bytes.
+    """
+    chunk = []
+    size = 0
+    for command in commands:
+        command = command.encode("UTF-8") + b"\n"
+        chunk += [command]
+        size += len(command)
+        if size >= _CHUNK_SIZE:
+            yield b"".join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield b"".join(chunk)
+
+
+class _LineSplitter(object):
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder("UTF-8")("replace")
+        self._partial = ""
+
+    def feed(self, data, final=False):
+        lines = (self._partial + self._decoder.decode(data, final)).splitlines(True)
+        self._partial = ""
+        if lines and not lines[-1].endswith("\n") and not final:
+            self._partial = lines.pop()
+        return lines
+
+
+def _select_engine(djvused, commands, stderr):
+    """
+    Feed commands to djvused, while reading its stdout and stderr, without
+    ever blocking on any of the pipes.
+
+    Yield output lines as soon as they are available.
+    """
+    chunks = _encode_commands(commands)
+    splitter = _LineSplitter()
+    stderr_size = 0
+    pending = memoryview(b"")
+    selector = selectors.DefaultSelector()
+    try:
+        for fo in djvused.stdin, djvused.stdout, djvused.stderr:
+            os.set_blocking(fo.fileno(), False)
+        selector.register(djvused.stdin, selectors.EVENT_WRITE)
+        selector.register(djvused.stdout, selectors.EVENT_READ)
+        selector.register(djvused.stderr, selectors.EVENT_READ)
+        while selector.get_map():
+            for key, events in selector.select():
+                fo = key.fileobj
+                if fo is djvused.stdin:
+                    if not pending:
+                        try:
+                            pending = memoryview(next(chunks))
+                        except StopIteration:
+                            selector.unregister(fo)
+                            fo.close()
+                            continue
+                    try:
+                        n = os.write(fo.fileno(), pending)
+                    except BrokenPipeError:
+                        # djvused died; the exit code will tell why.
+                        selector.unregister(fo)
+                        fo.close()
+                        continue
+                    except BlockingIOError:
+                        continue
+                    pending = pending[n:]
+                    continue
+                try:
+                    data = os.read(fo.fileno(), _CHUNK_SIZE)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    selector.unregister(fo)
+                    if fo is djvused.stdout:
+                        for line in splitter.feed(b"", final=True):
+                            yield line
+                elif fo is djvused.stdout:
+                    for line in splitter.feed(data):
+                        yield line
+                elif stderr_size < _STDERR_LIMIT:
+                    stderr += [data]
+                    stderr_size += len(data)
+    finally:
+        selector.close()
+
+
+def _threaded_engine(djvused, commands, stderr):
+    """
+    Fallback for systems where pipes cannot be polled: read stdout and
+    stderr in separate threads, and write commands in the current one.
+    """
+    queue = Queue(maxsize=64)
+
+    def read_stdout():
+        splitter = _LineSplitter()
+        for data in iter(lambda: djvused.stdout.read1(_CHUNK_SIZE), b""):
+            for line in splitter.feed(data):
+                queue.put(line)
+        for line in splitter.feed(b"", final=True):
+            queue.put(line)
+        queue.put(None)
+
+    def read_stderr():
+        size = 0
+        for data in iter(lambda: djvused.stderr.read1(_CHUNK_SIZE), b""):
+            if size < _STDERR_LIMIT:
+                stderr.append(data)
+                size += len(data)
+
+    def write_stdin():
+        try:
+            for chunk in _encode_commands(commands):
+                djvused.stdin.write(chunk)
+            djvused.stdin.close()
+        except (IOError, OSError):
+            # djvused died; the exit code will tell why.
+            pass
+
+    threads = [
+        threading.Thread(target=target)
+        for target in (read_stdout, read_stderr, write_stdin)
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for line in iter(queue.get, None):
+        yield line
+    for thread in threads:
+        thread.join()
+
+
+def _parse_block(command, lines):
+    if command == "set-ant":
+        return Expression.from_string("(%s)" % "".join(lines))
+    elif command == "set-txt":
+        text = "".join(lines)
+        if not text.strip():
+            return None
+        return Expression.from_string(text)
+    elif command == "set-meta":
+        result = {}
+        for line in lines:
+            if not line.strip():
+                continue
+            key, value = Expression.from_string("(%s)" % line)
+            result[key.value] = value.value
+        return result
+    elif command == "set-outline":
+        text = "".join(lines)
+        if not text.strip():
+            return None
+        return Expression.from_string(text)
+    raise ValueError(command)
+
+
+_script_token_re = re.compile(r'"(?:[^"\\]|\\.)*"?|[;#]|[^\s;#"]+')
+
+
+def _split_commands(line):
+    """
+    Split a line of a djvused script into commands, each of them a list of
+    words. Quoted strings are single words, so that ``;`` and ``#`` inside
+    them are not taken for command separators or comments.
+    """
+    commands = []
+    words = []
+    for match in _script_token_re.finditer(line):
+        token = match.group()
+        if token in (";", "#"):
+            if words:
+                commands += [words]
+                words = []
+            if token == "#":
+                return commands
+        else:
+            words += [token]
+    if words:
+        commands += [words]
+    return commands
+
+
+def parse_script(lines):
+    """
+    Parse a djvused script, as produced by the ``output-*`` commands.
+
+    Yield ``(page_no, kind, value)`` triples, where `page_no` is the 0-based
+    page number (`None` for the document and shared annotations), and `kind` is
+    one of ``'ant'``, ``'txt'``, ``'meta'``, ``'outline'``.
+    """
+    kinds = {
+        "set-ant": "ant",
+        "set-txt": "txt",
+        "set-meta": "meta",
+        "set-outline": "outline",
+    }
+    page_no = None
+    n_pages = 0
+    block = None
+    block_lines = None
+    for line in lines:
+        if block is not None:
+            if block_lines is None:
+                raise IOError("{line!r} outside of a block".format(line=line))
+            if line.rstrip("\r\n") == ".":
+                yield page_no, kinds[block], _parse_block(block, block_lines)
+                block = block_lines = None
+            else:
+                block_lines += [line]
+            continue
+        for command in _split_commands(line):
+            if block is not None:
+                # The block starts on the next line.
+                raise IOError(
+                    "unexpected {cmd!r} after {block!r}".format(
+                        cmd=command[0], block=block
+                    )
+                )
+            if command[0] == "select":
+                if len(command) > 1:
+                    page_no = n_pages
+                    n_pages += 1
+                else:
+                    page_no = None
+            elif command[0] in ("select-shared-ant", "create-shared-ant"):
+                page_no = None
+            elif command[0] in kinds:
+                block = command[0]
+                block_lines = []
+    if block is not None:
+        raise IOError("unterminated {cmd!r} block".format(cmd=block))
 
 
 # vim:ts=4 sts=4 sw=4 et
@@ -13,12 +13,121 @@
 # FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
 # more details.
 
+import ctypes
+import ctypes.util
+import errno
+import os
 import os.path
+import select
 import shutil
 import tempfile
+import threading
 
 from . import ipc
 
+# See inotify(7):
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = 0o2000000
+
+
+def _inotify_init(path):
+    """
+    Return an inotify file descriptor watching for files being written or
+    moved into the directory, or None if inotify is not available.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        inotify_init1 = libc.inotify_init1
+        inotify_add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return
+    fd = inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    if fd < 0:
+        return
+    mask = _IN_CLOSE_WRITE | _IN_MOVED_TO
+    if inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+        os.close(fd)
+        return
+    return fd
+
+
+class FileWatcher(object):
+    """
+    Call `callback` (in a separate thread) whenever the file at `path` is
+    saved.
+
+    inotify is used if available; otherwise, the file is polled every
+    `interval` seconds. Editors that save by replacing the file are
+    supported, as the whole directory is watched.
+    """
+
+    def __init__(self, path, callback, interval=0.5):
+        self._path = path
+        self._callback = callback
+        self._interval = interval
+        self._stamp = self._last_stamp = self._get_stamp()
+        self._stopped = threading.Event()
+        self._fd = _inotify_init(os.path.dirname(path))
+        if self._fd is None:
+            target = self._poll
+        else:
+            target = self._watch
+        self._thread = threading.Thread(target=target, name="djvusmooth-watch")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _get_stamp(self):
+        try:
+            st = os.stat(self._path)
+        except OSError:
+            return
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def _check(self, stable=True):
+        stamp = self._get_stamp()
+        if stamp is None or stamp == self._stamp:
+            self._last_stamp = stamp
+            return
+        if not stable and stamp != self._last_stamp:
+            # Possibly still being written. Wait for another check.
+            self._last_stamp = stamp
+            return
+        self._stamp = self._last_stamp = stamp
+        self._callback()
+
+    def _watch(self):
+        while not self._stopped.is_set():
+            ready, _, _ = select.select([self._fd], [], [], self._interval)
+            if not ready:
+                continue
+            try:
+                while os.read(self._fd, 4096):
+                    pass
+            except OSError as exc:
+                if exc.errno != errno.EAGAIN:
+                    raise
+            self._check()
+
+    def _poll(self):
+        while not self._stopped.wait(self._interval):
+            self._check(stable=False)
+
+    def stop(self):
+        """
+        Stop watching. Changes made since the last notification (if any) are
+        reported synchronously.
+        """
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._thread.join()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._check()
+
 
 class temporary_file(object):
     def __init__(self, name):
@@ -37,6 +146,14 @@ class temporary_file(object):
         self.fp.close()
         self.fp = None
 
+    def watch(self, callback, interval=0.5):
+        """
+        Call `callback` (in a separate thread) whenever the file is saved,
+        until the returned FileWatcher is stopped.
+        """
+        self.flush()
+        return FileWatcher(self.name, callback, interval=interval)
+
     def close(self):
         if self.dir is None:
             return
@@ -19,6 +19,7 @@ import itertools
 import functools
 import locale
 import os.path
+import sqlite3
 import threading
 from queue import Queue, Empty as QueueEmpty
 from apply import apply
@@ -33,7 +34,9 @@ import wx.lib.scrolledpanel
 import djvu.decode
 import djvu.const
 
-from djvusmooth.djvused import StreamEditor
+from djvusmooth.djvused import IndirectEditor, StreamEditor, Session
+from djvusmooth import djvused
+from djvusmooth import iff
 from djvusmooth.gui.page import (
     PageWidget,
     PercentZoom,
@@ -51,11 +54,16 @@ from djvusmooth.gui.maparea_browser import MapAreaBrowser
 from djvusmooth.gui.history import FileHistory
 from djvusmooth.gui import dialogs
 from djvusmooth.text import mangle as text_mangle
+from djvusmooth.text import flatten as text_flatten
 import djvusmooth.models.metadata
 import djvusmooth.models.annotations
 import djvusmooth.models.text
 from djvusmooth import models
 from djvusmooth import external_editor
+from djvusmooth.journal import Journal
+from djvusmooth.history import History
+from djvusmooth.prefetch import Prefetcher
+from djvusmooth.search import SearchIndex
 from djvusmooth import config
 
 from djvusmooth import __version__, __author__
@@ -93,6 +101,7 @@ class TextModel(models.text.Text):
 
     def reset_document(self, document):
         self._document = document
+        self.forget_preloaded()
 
     def acquire_data(self, n):
         text = self._document.pages[n].text
@@ -153,26 +162,105 @@ class DocumentProxy(object):
 
 
 class AnnotationsModel(models.annotations.Annotations):
-    def __init__(self, document_path):
+
+    # These are handled by MetadataModel, and are not printed by djvused's
+    # print-ant either:
+    _ignored_symbols = frozenset(
+        [djvu.sexpr.Symbol("metadata"), djvu.sexpr.Symbol("xmp")]
+    )
+
+    def __init__(self, document, document_path, session):
         models.annotations.Annotations.__init__(self)
-        self.__djvused = StreamEditor(document_path)
+        self._document = document
+        self.__session = session
+        self.__djvused = StreamEditor(document_path, session=session)
+        self._ignored_items = {}
 
     def reset_document(self, document):
-        pass  # Nothing to do
+        self._document = document
+        self.forget_preloaded()
+        # They might have been changed by saving through djvused:
+        self._ignored_items = {}
+        # The file has changed under the djvused process:
+        self.__session.close()
+
+    def _is_ignored(self, item):
+        return (
+            not isinstance(item, djvu.sexpr.ListExpression)
+            or len(item) == 0
+            or item[0].value in self._ignored_symbols
+        )
 
-    def acquire_data(self, n):
+    def _filter(self, items):
+        return [item for item in items if not self._is_ignored(item)]
+
+    def get_ignored_items(self, n):
+        """
+        Return the page annotations that are not part of the model (such as
+        metadata), or `None` if they are not known.
+        """
+        if n not in self._ignored_items:
+            try:
+                self._get_page_items(n)
+            except (djvu.decode.NotAvailable, djvu.decode.JobFailed):
+                return
+        return self._ignored_items.get(n)
+
+    def _get_page_items(self, n):
+        """
+        Return the page's own annotations as decoded by ddjvu, or `None` if
+        they can't be told apart from the shared ones.
+        """
+        document_annotations = self._document.annotations
+        document_annotations.wait()
+        page_annotations = self._document.pages[n].annotations
+        page_annotations.wait()
+        items = list(page_annotations.sexpr or ())
+        shared_items = frozenset(str(item) for item in document_annotations.sexpr or ())
+        if any(str(item) in shared_items for item in items):
+            # Page annotations include the shared ones, but the page could also
+            # have its own copies of them; they can't be told apart here.
+            return
+        self._ignored_items[n] = [item for item in items if self._is_ignored(item)]
+        return items
+
+    def _acquire_decoded_data(self, n):
+        """
+        Return annotations as decoded by ddjvu, or `None` if the page's own
+        annotations can't be told apart from the shared ones.
+        """
+        if n == models.SHARED_ANNOTATIONS_PAGENO:
+            document_annotations = self._document.annotations
+            document_annotations.wait()
+            items = document_annotations.sexpr or ()
+        else:
+            items = self._get_page_items(n)
+            if items is None:
+                return
+        return djvu.sexpr.Expression(self._filter(items))
+
+    def _acquire_djvused_data(self, n):
         djvused = self.__djvused
         if n == models.SHARED_ANNOTATIONS_PAGENO:
             djvused.select_shared_annotations()
         else:
             djvused.select(n + 1)
         djvused.print_annotations()
-        s = "(%s)" % djvused.commit()  # FIXME: optimize
+        s = "(%s)" % djvused.commit()
         try:
             return djvu.sexpr.Expression.from_string(s)
         except djvu.sexpr.ExpressionSyntaxError:
             raise  # FIXME
 
+    def acquire_data(self, n):
+        try:
+            result = self._acquire_decoded_data(n)
+        except (djvu.decode.NotAvailable, djvu.decode.JobFailed):
+            result = None
+        if result is None:
+            result = self._acquire_djvused_data(n)
+        return result
+
 
 class MetadataModel(models.metadata.Metadata):
     def __init__(self, document):
@@ -181,6 +269,7 @@ class MetadataModel(models.metadata.Metadata):
 
     def reset_document(self, document):
         self._document = document
+        self.forget_preloaded()
 
     def acquire_data(self, n):
         document_annotations = self._document.annotations
@@ -264,6 +353,9 @@ class PageAnnotationsCallback(models.annotations.PageAnnotationsCallback):
     def notify_node_replace(self, node, other_node):
         self._owner.dirty = True
 
+    def notify_mapareas_change(self):
+        self._owner.dirty = True
+
     def notify_node_select(self, node):
         try:
             self._owner.SetStatusText(_("Link: %s") % node.uri)
@@ -295,6 +387,9 @@ def skip_if_being_deleted(method):
 
 
 class MainWindow(wx.Frame):
+
+    max_search_hits = 1000
+
     @apply
     def default_xywh():
         def get(self):
@@ -345,6 +440,27 @@ class MainWindow(wx.Frame):
 
         return property(get, set)
 
+    @apply
+    def default_page_cache_size():
+        def get(self):
+            return self._config.read_int("page_cache_size", 200) or None
+
+        def set(self, value):
+            self._config["page_cache_size"] = value or 0
+
+        return property(get, set)
+
+    @apply
+    def default_history_size():
+        def get(self):
+            # in MiB
+            return self._config.read_int("history_size", 64) or None
+
+        def set(self, value):
+            self._config["history_size"] = value or 0
+
+        return property(get, set)
+
     @apply
     def default_open_dir():
         def get(self):
@@ -415,8 +531,18 @@ class MainWindow(wx.Frame):
         self.file_history = FileHistory(self._config)
         self.create_menus()
         self.dirty = False
+        self.djvused_session = None
+        self.chunk_index = None
+        self.journal = None
+        self.history = None
+        self.prefetcher = None
+        self.search_index = None
+        self._last_query = ""
         self.do_open(None)
         self.Bind(wx.EVT_CLOSE, self.on_exit)
+        self.journal_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.on_journal_timer, self.journal_timer)
+        self.journal_timer.Start(int(Journal.flush_interval * 1000))
 
     def create_menus(self):
         menu_bar = wx.MenuBar()
@@ -477,11 +603,31 @@ class MainWindow(wx.Frame):
     def _create_edit_menu(self):
         menu = wx.Menu()
         menu_item = functools.partial(self._create_menu_item, menu)
+        menu_item(
+            _("&Undo") + "\tCtrl+Z",
+            _("Undo the last change"),
+            self.on_undo,
+            icon=wx.ART_UNDO,
+            id=wx.ID_UNDO,
+        )
+        menu_item(
+            _("&Redo") + "\tCtrl+Shift+Z",
+            _("Redo the last undone change"),
+            self.on_redo,
+            icon=wx.ART_REDO,
+            id=wx.ID_REDO,
+        )
+        menu.AppendSeparator()
         menu_item(
             _("&Metadata") + "\tCtrl+M",
             _("Edit the document or page metadata"),
             self.on_edit_metadata,
         )
+        menu_item(
+            _("&Find…") + "\tCtrl+F",
+            _("Find words in the text of all pages"),
+            self.on_find,
+        )
         submenu = wx.Menu()
         submenu_item = functools.partial(self._create_menu_item, submenu)
         submenu_item(
@@ -489,6 +635,11 @@ class MainWindow(wx.Frame):
             _("Edit page text in an external editor"),
             self.on_external_edit_text,
         )
+        submenu_item(
+            _("Edit &all text…"),
+            _("Edit text of all pages in an external editor"),
+            self.on_external_edit_all_text,
+        )
         submenu_item(
             _("&Flatten"), _("Remove details from page text"), self.on_flatten_text
         )
@@ -763,8 +914,13 @@ class MainWindow(wx.Frame):
             w, h = self.GetSize()
             self.default_xywh = x, y, w, h
             self.save_defaults()
+            self.journal_timer.Stop()
             self.Destroy()
 
+    def on_journal_timer(self, event):
+        if self.journal is not None:
+            self.journal.flush()
+
     def on_open(self, event):
         dialog = OpenDialog(self)
         dialog.SetDirectory(self.default_open_dir)
@@ -787,23 +943,47 @@ class MainWindow(wx.Frame):
         if not self.dirty:
             return True
         queue = Queue()
-        sed = StreamEditor(self.path, autosave=True)
+        if self.document.type == djvu.decode.DOCUMENT_TYPE_INDIRECT:
+            sed = IndirectEditor(
+                os.fsdecode(self.path), page_files=self.get_page_file_name
+            )
+        else:
+            sed = StreamEditor(os.fsdecode(self.path), autosave=True)
         for model in self.models:
             model.export(sed)
+        native_editor = iff.NativeEditor(
+            self.path,
+            page_files=self.get_page_file_name,
+            extra_annotations=self.annotations_model.get_ignored_items,
+        )
+        try:
+            for model in self.models:
+                model.export(native_editor)
+        except iff.NotSupported:
+            native_editor = None
+        if self.prefetcher is not None:
+            # The workers mustn't read the file while it's being replaced:
+            self.prefetcher.pause()
 
         def job():
             try:
-                sed.commit()
+                try:
+                    if native_editor is None:
+                        raise iff.NotSupported
+                    native_editor.commit()
+                except iff.NotSupported:
+                    sed.commit_atomically()
                 self.document = self.context.new_document(
                     djvu.decode.FileURI(self.path)
                 )
                 for model in self.models:
                     model.reset_document(self.document)
             except Exception as exception:
-                pass
+                # The name is unbound at the end of the except clause.
+                error = exception
             else:
-                exception = None
-            queue.put(exception)
+                error = None
+            queue.put(error)
 
         thread = threading.Thread(target=job)
         thread.start()
@@ -834,7 +1014,15 @@ class MainWindow(wx.Frame):
             thread.join()
             if dialog is not None:
                 dialog.Destroy()
+            if self.prefetcher is not None:
+                self.prefetcher.resume()
+        for model in self.models:
+            model.mark_saved()
         self.dirty = False
+        if self.journal is not None:
+            self.journal.discard()
+        if self.search_index is not None:
+            self.search_index.notify_saved()
         return True
 
     def on_show_sidebar(self, event):
@@ -886,14 +1074,26 @@ class MainWindow(wx.Frame):
     def on_refresh(self, event):
         self.Refresh()
 
+    def get_page_file_name(self, page_no):
+        """
+        Return path to the file containing the page of an indirect document.
+        """
+        file_name = self.document.pages[page_no].file.name
+        directory = os.path.dirname(os.fsdecode(self.path))
+        return os.path.join(directory, file_name)
+
     def get_page_uri(self, page_no=None):
         if page_no is None:
             page_no = self.page_no
+        index = self.chunk_index
         try:
-            id = self.document.pages[page_no].file.id
+            if index is None:
+                return "#" + self.document.pages[page_no].file.id
+            if index.page_ids is None:
+                index.set_page_ids(page.file.id for page in self.document.pages)
         except djvu.decode.NotAvailable:
-            id = str(page_no)
-        return "#" + id
+            return "#" + str(page_no)
+        return "#" + index.page_ids[page_no]
 
     @apply
     def page_no():
@@ -907,6 +1107,8 @@ class MainWindow(wx.Frame):
                 return
             if n < 0 or n >= len(self.document.pages):
                 return
+            if self.prefetcher is not None:
+                self.prefetcher.schedule(n, direction=(n - self._page_no))
             self._page_no = n
             self.status_bar.SetStatusText(
                 _("Page %(pageno)d of %(npages)d")
@@ -960,14 +1162,83 @@ class MainWindow(wx.Frame):
         )
         try:
             if dialog.ShowModal() == wx.ID_OK:
-                self.metadata_model[
-                    models.SHARED_ANNOTATIONS_PAGENO
-                ] = document_metadata_model
-                self.metadata_model[self.page_no] = page_metadata_model
+                with self.history.group():
+                    self.metadata_model[
+                        models.SHARED_ANNOTATIONS_PAGENO
+                    ] = document_metadata_model
+                    self.metadata_model[self.page_no] = page_metadata_model
                 self.dirty = True
         finally:
             dialog.Destroy()
 
+    def on_undo(self, event):
+        if self.history.can_undo():
+            self.after_undo(self.history.undo())
+
+    def on_redo(self, event):
+        if self.history.can_redo():
+            self.after_undo(self.history.redo())
+
+    def after_undo(self, page_no):
+        if page_no is not None and page_no != self.page_no:
+            # Show what has changed:
+            self.page_no = page_no
+        # Undoing all the changes brings the document back to the saved state:
+        self.dirty = any(model.is_modified() for model in self.models)
+
+    def on_find(self, event):
+        if self.search_index is None:
+            return
+        dialog = wx.TextEntryDialog(
+            self, caption=_("Find"), message=_("Enter a word to find.")
+        )
+        try:
+            dialog.SetValue(self._last_query)
+            if dialog.ShowModal() != wx.ID_OK:
+                return
+            query = self._last_query = dialog.GetValue()
+        finally:
+            dialog.Destroy()
+        busy = wx.BusyCursor()
+        try:
+            hits = self.search_index.search(query, limit=self.max_search_hits)
+        finally:
+            del busy
+        message = _("Matches: %d") % len(hits)
+        if len(hits) >= self.max_search_hits:
+            message = _("More than %d matches; only the first ones are shown.") % (
+                self.max_search_hits
+            )
+        if not self.search_index.is_complete():
+            n_indexed, n_pages = self.search_index.get_progress()
+            message += "\n" + _(
+                "The text is still being indexed (%(n)d of %(total)d pages); "
+                "some matches may be missing."
+            ) % dict(n=n_indexed, total=n_pages)
+        if not hits:
+            wx.MessageBox(message=message, caption=_("Find"), parent=self)
+            return
+        choices = [
+            _("Page %(pageno)d: %(text)s")
+            % dict(pageno=(hit.page_no + 1), text=hit.text)
+            for hit in hits
+        ]
+        dialog = wx.SingleChoiceDialog(
+            self, message=message, caption=_("Find"), choices=choices
+        )
+        try:
+            if dialog.ShowModal() != wx.ID_OK:
+                return
+            hit = hits[dialog.GetSelection()]
+        finally:
+            dialog.Destroy()
+        self.page_no = hit.page_no
+        page_text = self.text_model[hit.page_no]
+        for node in page_text.find_nodes_in_rect(hit.rect, contained=True):
+            if tuple(node.rect) == tuple(hit.rect):
+                node.notify_select()
+                break
+
     def on_flatten_text(self, event):
         dialog = FlattenTextDialog(self)
         zone = None
@@ -980,11 +1251,89 @@ class MainWindow(wx.Frame):
         if zone is None:
             return
         if scope_all:
-            page_nos = range(len(self.document.pages))
+            self.flatten_all_pages(zone)
         else:
-            page_nos = (self.page_no,)
-        for page_no in page_nos:
-            self.text_model[page_no].strip(zone)
+            self.text_model[self.page_no].strip(zone)
+
+    def flatten_all_pages(self, zone):
+        """
+        Flatten text of all the pages. Pages that haven't been loaded yet are
+        processed in worker processes.
+        """
+        page_nos = range(len(self.document.pages))
+        loaded_page_nos = [n for n in page_nos if self.text_model.is_loaded(n)]
+        unloaded_page_nos = [n for n in page_nos if not self.text_model.is_loaded(n)]
+        flattener = None
+        if unloaded_page_nos:
+            flattener = text_flatten.Flattener(self.path, unloaded_page_nos, zone)
+            dialog = dialogs.ProgressDialog(
+                title=_("Flattening text"),
+                message=_("Flattening text of all pages, please wait…"),
+                maximum=flattener.n_pages,
+                parent=self,
+                style=(
+                    wx.PD_APP_MODAL
+                    | wx.PD_CAN_ABORT
+                    | wx.PD_ELAPSED_TIME
+                    | wx.PD_REMAINING_TIME
+                ),
+            )
+            try:
+                while not flattener.done:
+                    flattener.wait(timeout=0.1)
+                    keep_going, skip = dialog.Update(flattener.n_done)
+                    if not keep_going:
+                        flattener.cancel()
+                        return
+            finally:
+                dialog.Destroy()
+                flattener.close()
+            loaded_page_nos += flattener.failed
+        busy = wx.BusyCursor()
+        try:
+            with self.history.group():
+                if flattener is not None:
+                    for page_no, original, stripped in flattener.results:
+                        self.text_model.preload(page_no, original)
+                        self.text_model[page_no].raw_value = stripped
+                        # Only the current page's model is being watched:
+                        self.dirty = True
+                for page_no in loaded_page_nos:
+                    self.text_model[page_no].strip(zone)
+        finally:
+            del busy
+
+    def preload_models(self):
+        """
+        Load all the pages' text, annotations and metadata with a single
+        djvused pass, rather than page by page.
+        """
+        busy = wx.BusyCursor()
+        try:
+            sed = StreamEditor(self.path, session=self.djvused_session)
+            sed.output_all()
+            models_by_kind = dict(
+                txt=self.text_model,
+                ant=self.annotations_model,
+                meta=self.metadata_model,
+            )
+            for page_no, kind, value in djvused.parse_script(sed.commit_lines()):
+                model = models_by_kind.get(kind)
+                if model is None:
+                    # The outline is loaded eagerly, when opening the document.
+                    continue
+                if page_no is None:
+                    if kind != "meta":
+                        continue
+                    page_no = models.SHARED_ANNOTATIONS_PAGENO
+                model.preload(page_no, value)
+            # djvused doesn't output anything for pages without text etc.:
+            for page_no in range(len(self.document.pages)):
+                self.text_model.preload(page_no, None)
+                self.annotations_model.preload(page_no, djvu.sexpr.Expression(()))
+                self.metadata_model.preload(page_no, {})
+        finally:
+            del busy
 
     def on_bookmark_current_page(self, event):
         uri = self.get_page_uri()
@@ -997,90 +1346,202 @@ class MainWindow(wx.Frame):
     def on_remove_outline(self, event):
         self.outline_model.remove()
 
-    def on_external_edit_outline(self, event):
-        model = self.outline_model
+    def run_external_editor(self, name, export, on_save):
+        """
+        Export data into a temporary file with export(file), and open the file
+        in the external editor, without blocking the main window.
 
-        def job(disabler):
-            new_repr = None
+        on_save(lines) is called (in a separate thread) whenever the file is
+        saved, until the editor exits.
+        """
+
+        def on_file_save(path):
             try:
-                with external_editor.temporary_file("outline.txt") as tmp_file:
-                    model.export_as_plaintext(tmp_file)
-                    tmp_file.flush()
-                    self.external_editor(tmp_file.name)
-                    tmp_file.seek(0)
-                    new_repr = list(map(str.expandtabs, map(str.rstrip, tmp_file)))
+                with open(path) as file:
+                    on_save(list(file))
             except Exception as exception:
-                pass
-            else:
-                exception = None
-            wx.CallAfter(
-                self.after_external_edit_outline, new_repr, disabler, exception
-            )
-            disabler = exception = None
+                wx.CallAfter(self.on_external_edit_failed, exception)
 
-        disabler = wx.WindowDisabler()
-        thread = threading.Thread(target=job, args=(disabler,))
+        def job():
+            try:
+                with external_editor.temporary_file(name) as tmp_file:
+                    export(tmp_file)
+                    watcher = tmp_file.watch(
+                        functools.partial(on_file_save, tmp_file.name)
+                    )
+                    try:
+                        self.external_editor(tmp_file.name)
+                    finally:
+                        watcher.stop()
+            except Exception as exception:
+                wx.CallAfter(self.on_external_edit_failed, exception)
+
+        thread = threading.Thread(target=job)
+        thread.daemon = True
         thread.start()
 
+    def on_external_edit_outline(self, event):
+        model = self.outline_model
+        last_repr = None
+
+        def export(tmp_file):
+            nonlocal last_repr
+            model.export_as_plaintext(tmp_file)
+            tmp_file.seek(0)
+            last_repr = list(map(str.expandtabs, map(str.rstrip, tmp_file)))
+
+        def on_save(lines):
+            nonlocal last_repr
+            new_repr = list(map(str.expandtabs, map(str.rstrip, lines)))
+            if new_repr == last_repr:
+                return
+            last_repr = new_repr
+            wx.CallAfter(self.after_external_edit_outline, model, new_repr)
+
+        self.run_external_editor("outline.txt", export, on_save)
+
     def on_external_edit_failed(self, exception):
-        self.error_box(
-            _("External edit failed:\n%s")
-            % str(exception).decode(system_encoding, "replace")
-        )
+        if isinstance(exception, text_mangle.CharacterZoneFound):
+            self.error_box(_("Cannot edit text with character zones."))
+            return
+        if isinstance(exception, text_mangle.LengthChanged):
+            self.error_box(_("Number of lines changed."))
+            return
+        self.error_box(_("External edit failed:\n%s") % exception)
 
-    def after_external_edit_outline(self, new_repr, disabler, exception):
-        if exception is not None:
-            self.on_external_edit_failed(exception)
+    def after_external_edit_outline(self, model, new_repr):
+        if model is not self.outline_model:
+            # The document has been closed in the meantime.
             return
-        # TODO: how to check if actually something changed?
-        self.outline_model.import_plaintext(new_repr)
+        # Outline entries have no identity that would survive editing, so the
+        # whole outline is re-imported.
+        model.import_plaintext(new_repr)
 
     def on_external_edit_text(self, event):
-        sexpr = self.text_model[self.page_no].raw_value
+        model = self.text_model
+        page_no = self.page_no
+        sexpr = model[page_no].raw_value
         if not sexpr:
             self.error_box(_("No text layer to edit."))
             return
 
-        def job(disabler):
-            new_sexpr = None
-            try:
-                with external_editor.temporary_file("text.txt") as tmp_file:
-                    text_mangle.export(sexpr, tmp_file)
-                    tmp_file.flush()
-                    self.external_editor(tmp_file.name)
-                    tmp_file.seek(0)
-                    try:
-                        new_sexpr = text_mangle.import_(sexpr, tmp_file)
-                    except text_mangle.NothingChanged:
-                        pass
-            except Exception as exception:
-                pass
-            else:
-                exception = None
-            wx.CallAfter(self.after_external_edit_text, new_sexpr, disabler, exception)
-            disabler = exception = None
+        # Text as last exported or imported, per page:
+        last_lines = {}
 
-        disabler = wx.WindowDisabler()
-        thread = threading.Thread(target=job, args=(disabler,))
-        thread.start()
+        def export(tmp_file):
+            text_mangle.export(sexpr, tmp_file)
+            tmp_file.seek(0)
+            last_lines[page_no] = list(tmp_file)
+
+        def on_save(lines):
+            wx.CallAfter(
+                self.after_external_edit_text, model, page_no, last_lines, lines
+            )
+
+        self.run_external_editor("text.txt", export, on_save)
 
-    def after_external_edit_text(self, sexpr, disabler, exception):
-        if exception is not None:
+    def after_external_edit_text(self, model, page_no, last_lines, lines):
+        if model is not self.text_model:
+            # The document has been closed in the meantime.
+            return
+        # The page could have been modified in the meantime. Only lines
+        # changed since the last import are imported, so that the file's stale
+        # copies of the other lines don't revert these modifications.
+        sexpr = model[page_no].raw_value
+        if not sexpr:
+            self.error_box(_("No text layer to edit."))
+            return
+        try:
+            sexpr = text_mangle.import_changes(sexpr, last_lines[page_no], lines)
+        except text_mangle.NothingChanged:
+            last_lines[page_no] = lines
+            return
+        except Exception as exception:
+            self.on_external_edit_failed(exception)
+            return
+        last_lines[page_no] = lines
+        model[page_no].raw_value = sexpr
+        # Only the current page's model is being watched:
+        self.dirty = True
+
+    def on_external_edit_all_text(self, event):
+        self.preload_models()
+        model = self.text_model
+        pages = [
+            (page_no, model[page_no].raw_value)
+            for page_no in range(len(self.document.pages))
+        ]
+        digests = {}
+        # Text as last exported or imported, per page:
+        last_lines = {}
+
+        def export(tmp_file):
+            digests.update(text_mangle.export_pages(pages, tmp_file))
+            tmp_file.seek(0)
+            last_lines.update(text_mangle.split_pages(tmp_file))
+
+        def on_save(lines):
+            changes = []
+            errors = []
             try:
-                raise exception
-            except text_mangle.CharacterZoneFound:
-                self.error_box(_("Cannot edit text with character zones."))
-                return
-            except text_mangle.LengthChanged:
-                self.error_box(_("Number of lines changed."))
-                return
-            except Exception:
-                self.on_external_edit_failed(exception)
+                sections = list(text_mangle.split_pages(lines))
+            except text_mangle.MalformedPageSeparator as exception:
+                wx.CallAfter(
+                    self.error_box, _("Text was not imported:\n%s") % exception
+                )
                 return
-        if sexpr is None:
-            # nothing changed
+            for page_no, page_lines in sections:
+                if page_no not in digests:
+                    errors += [(page_no, _("Unexpected page."))]
+                    continue
+                digest = text_mangle.get_lines_digest(page_lines)
+                if digest == digests[page_no]:
+                    continue
+                digests[page_no] = digest
+                changes += [(page_no, page_lines)]
+            wx.CallAfter(
+                self.after_external_edit_all_text, model, last_lines, changes, errors
+            )
+
+        self.run_external_editor("text.txt", export, on_save)
+
+    def after_external_edit_all_text(self, model, last_lines, changes, errors):
+        if model is not self.text_model:
+            # The document has been closed in the meantime.
             return
-        self.text_model[self.page_no].raw_value = sexpr
+        results = []
+        for page_no, lines in changes:
+            sexpr = model[page_no].raw_value
+            if not sexpr:
+                errors += [(page_no, _("No text layer to edit."))]
+                continue
+            try:
+                sexpr = text_mangle.import_changes(sexpr, last_lines[page_no], lines)
+            except text_mangle.NothingChanged:
+                last_lines[page_no] = lines
+                continue
+            except text_mangle.LengthChanged:
+                errors += [(page_no, _("Number of lines changed."))]
+                continue
+            except text_mangle.CharacterZoneFound:
+                errors += [(page_no, _("Cannot edit text with character zones."))]
+                continue
+            last_lines[page_no] = lines
+            results += [(page_no, sexpr)]
+        if results:
+            with self.history.group():
+                for page_no, sexpr in results:
+                    model[page_no].raw_value = sexpr
+            # Only the current page's model is being watched:
+            self.dirty = True
+        if errors:
+            self.error_box(
+                _("Text of some pages was not imported:\n%s")
+                % "\n".join(
+                    _("page %(n)d: %(error)s") % dict(n=(page_no + 1), error=error)
+                    for page_no, error in errors
+                )
+            )
 
     def do_percent_zoom(self, percent):
         self.page_widget.zoom = PercentZoom(percent)
@@ -1134,6 +1595,21 @@ class MainWindow(wx.Frame):
                     return False
             finally:
                 dialog.Destroy()
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+        if self.search_index is not None:
+            self.search_index.close()
+            self.search_index = None
+        if self.journal is not None:
+            # The user has just decided what to do with the changes.
+            self.journal.discard()
+            self.journal = None
+        self.history = None
+        if self.djvused_session is not None:
+            self.djvused_session.close()
+            self.djvused_session = None
+        self.chunk_index = None
         self.path = path
         self.document = None
         self.page_no = 0
@@ -1150,18 +1626,45 @@ class MainWindow(wx.Frame):
         else:
             self.file_history.add(path)
             self.default_open_dir = os.path.dirname(path)
+            try:
+                # Undo an interrupted in-place save, if any:
+                iff.recover(path)
+            except (IOError, OSError) as exception:
+                self.error_box(
+                    _("Restoring the document after an interrupted save failed:\n%s")
+                    % exception
+                )
+            try:
+                self.chunk_index = iff.ChunkIndex.load(path)
+            except (iff.FormatError, IOError, OSError):
+                # The index is merely an optimization.
+                self.chunk_index = None
             try:
                 self.document = self.context.new_document(djvu.decode.FileURI(path))
                 self.metadata_model = MetadataModel(self.document)
                 self.text_model = TextModel(self.document)
                 self.outline_model = OutlineModel(self.document)
-                self.annotations_model = AnnotationsModel(path)
+                self.djvused_session = Session(path)
+                self.annotations_model = AnnotationsModel(
+                    self.document, path, self.djvused_session
+                )
                 self.models = (
                     self.metadata_model,
                     self.text_model,
                     self.outline_model,
                     self.annotations_model,
                 )
+                for model in (
+                    self.metadata_model,
+                    self.text_model,
+                    self.annotations_model,
+                ):
+                    model.cache_size = self.default_page_cache_size
+                self.prefetcher = Prefetcher(
+                    (self.text_model, self.annotations_model),
+                    len(self.document.pages),
+                )
+                self.start_search_index()
                 self.enable_edit(True)
             except djvu.decode.JobFailed:
                 clear_models()
@@ -1171,8 +1674,67 @@ class MainWindow(wx.Frame):
         self.update_title()
         self.update_page_widget(new_document=True, new_page=True)
         self.dirty = False
+        if self.document is not None:
+            self.start_journal()
+            self.start_history()
         return True
 
+    def start_search_index(self):
+        try:
+            self.search_index = SearchIndex(
+                self.path, len(self.document.pages), self.text_model.acquire_data
+            )
+        except (sqlite3.Error, IOError, OSError):
+            # Searching is not essential; carry on without it.
+            return
+        self.search_index.attach(self.text_model)
+
+    def start_journal(self):
+        models = (
+            self.text_model,
+            self.annotations_model,
+            self.metadata_model,
+            self.outline_model,
+        )
+        try:
+            self.journal = Journal(self.path)
+        except (IOError, OSError):
+            return
+        records = self.journal.read()
+        recover = False
+        if records:
+            dialog = wx.MessageDialog(
+                self,
+                _(
+                    "This document has unsaved changes from a previous session. "
+                    "Do you want to recover them?"
+                ),
+                "",
+                wx.YES_NO | wx.YES_DEFAULT | wx.ICON_QUESTION,
+            )
+            try:
+                recover = dialog.ShowModal() == wx.ID_YES
+            finally:
+                dialog.Destroy()
+        self.journal.start(keep=recover)
+        if recover:
+            self.journal.replay(records, *models)
+            self.update_page_widget(new_page=True)
+            self.dirty = True
+        self.journal.attach(*models)
+
+    def start_history(self):
+        max_size = self.default_history_size
+        if max_size is not None:
+            max_size <<= 20
+        self.history = History(max_size)
+        self.history.attach(
+            self.text_model,
+            self.annotations_model,
+            self.metadata_model,
+            self.outline_model,
+        )
+
     def update_page_widget(self, new_document=False, new_page=False):
         if self.document is None:
             self.page_widget.Hide()
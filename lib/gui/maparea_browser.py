@@ -48,6 +48,9 @@ class PageAnnotationsCallback(models.annotations.PageAnnotationsCallback):
     def notify_node_delete(self, node):
         wx.CallAfter(lambda: self._owner.on_node_delete(node))
 
+    def notify_mapareas_change(self):
+        wx.CallAfter(self._owner.on_mapareas_change)
+
 
 def item_to_id(item):
     try:
@@ -118,6 +121,9 @@ class MapAreaBrowser(
     def on_node_delete(self, node):
         self._remove_item(node)
 
+    def on_mapareas_change(self):
+        self._recreate_items()
+
     def on_node_select(self, node):
         try:
             current_item = self._data_map[node]
@@ -145,9 +145,7 @@ class PageImage(wx.lib.ogl.RectangleShape):
         canvas = shape.GetCanvas()
         dc = wx.ClientDC(canvas)
         canvas.PrepareDC(dc)
-        to_deselect = list(
-            shape for shape in canvas.GetDiagram().GetShapeList() if shape.Selected()
-        )
+        to_deselect = canvas.get_selected_shapes()
         for shape in to_deselect:
             shape.Select(False, dc)
         if to_deselect:
@@ -298,9 +296,7 @@ class NodeShape(wx.lib.ogl.RectangleShape):
             canvas, dc = cdc
         except TypeError:
             canvas, dc = self.get_cdc()
-        to_deselect = list(
-            shape for shape in canvas.GetDiagram().GetShapeList() if shape.Selected()
-        )
+        to_deselect = canvas.get_selected_shapes()
         self.Select(True, dc)
         for shape in to_deselect:
             shape.Select(False, dc)
@@ -392,6 +388,9 @@ class MapareaCallback(models.annotations.PageAnnotationsCallback):
     def notify_node_replace(self, node, other_node):
         self._widget.on_maparea_replace(node, other_node)
 
+    def notify_mapareas_change(self):
+        self._widget.page = True
+
 
 class ShapeEventHandler(wx.lib.ogl.ShapeEvtHandler):
     def __init__(self, widget):
@@ -447,6 +446,50 @@ class PageWidget(wx.lib.ogl.ShapeCanvas):
             return
         wx.lib.ogl.ShapeCanvas.OnMouseEvent(self, event)
 
+    def FindShape(self, x, y, info=None, notObject=None):
+        # Look the point up in the models' spatial indices, rather than
+        # hit-testing every shape of the diagram.
+        nodes = None
+        if info is None and notObject is None:
+            nodes = self.find_nodes_at((x, y))
+        if nodes is None:
+            return wx.lib.ogl.ShapeCanvas.FindShape(self, x, y, info, notObject)
+        current_shape = self._current_shape
+        if current_shape is not None and current_shape.Selected():
+            # Control points are drawn on top of everything else.
+            for control_point in current_shape._controlPoints:
+                hit = control_point.HitTest(x, y)
+                if hit:
+                    return control_point, hit[0]
+        shapes_map = self._nonraster_shapes_map
+        for node in nodes:
+            shape = shapes_map.get(node)
+            if shape is not None and shape.IsShown():
+                return shape, 0
+        image = self._image
+        if image is not None and image.HitTest(x, y):
+            return image, 0
+        return None, 0
+
+    def find_nodes_at(self, point):
+        """
+        Return nodes displayed at the point (in screen coordinates), topmost
+        first; or None if no nodes are displayed.
+        """
+        mode = self.render_nonraster
+        if mode == RENDER_NONRASTER_TEXT and self._page_text is not None:
+            x, y = self._xform_text_to_screen.inverse(point)
+            return self._page_text.find_nodes_at(x, y)
+        if mode == RENDER_NONRASTER_MAPAREA and self._page_annotations is not None:
+            x, y = self._xform_real_to_screen.inverse(point)
+            return self._page_annotations.find_mapareas_at(x, y)
+
+    def get_selected_shapes(self):
+        shape = self._current_shape
+        if shape is not None and shape.Selected():
+            return [shape]
+        return []
+
     def on_char(self, event):
         skip = True
         try:
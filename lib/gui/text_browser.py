@@ -149,15 +149,15 @@ class TextBrowser(wx.TreeCtrl):
         node.text = text
         return True
 
-    def _add_children(self, item, parent_node):
-        if not parent_node.is_inner():
-            return
-        for node in parent_node:
-            symbol = node.type
+    def _add_descendants(self, page_text):
+        items = self._items
+        nodes = iter(page_text.get_preorder_nodes())
+        next(nodes)  # the root node
+        # Parents are visited before their children, and siblings in order:
+        for node in nodes:
             label = get_label_for_node(node)
-            child_item = self.AppendItem(item, label)
-            self._add_children(child_item, node)
-            self._items[node] = child_item
+            child_item = self.AppendItem(items[node.parent], label)
+            items[node] = child_item
             self.SetPyData(child_item, node)
 
     def _recreate_children(self):
@@ -174,7 +174,7 @@ class TextBrowser(wx.TreeCtrl):
             self._items[node] = root
             self.SetPyData(root, node)
             self._have_root = True
-            self._add_children(root, node)
+            self._add_descendants(self.page.text)
 
 
 __all__ = ["TextBrowser"]
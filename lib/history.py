@@ -0,0 +1,392 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2019 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+"""
+Undo/redo history of the models.
+
+Every change of a model is recorded as a snapshot of the state preceding it.
+Snapshots of text and outline are their s-expressions. The models cache the
+serialisations of their nodes, and a change invalidates only the node and its
+ancestors, so consecutive snapshots share everything except the changed path.
+Snapshots of annotations are tuples of maparea s-expressions, again sharing
+the unchanged ones; snapshots of metadata are plain dictionaries.
+
+The memory used by the snapshots is only estimated, from the size of the
+parts that are not shared. When the estimate exceeds the limit, the oldest
+steps are forgotten.
+"""
+
+import contextlib
+import weakref
+
+from djvusmooth.models import annotations
+from djvusmooth.models import outline
+from djvusmooth.models import text
+
+# Rough sizes (in bytes) of a zone or node without its children, and of a
+# reference to a child:
+_NODE_SIZE = 64
+_LINK_SIZE = 16
+
+
+def _get_path_size(node):
+    """
+    Estimate the size of serialisations of the node and its ancestors.
+    """
+    size = _NODE_SIZE
+    while True:
+        try:
+            node = node.parent
+        except StopIteration:
+            break
+        size += _NODE_SIZE + _LINK_SIZE * len(node)
+    return size
+
+
+def _get_sexpr_size(sexpr):
+    if sexpr is None:
+        return 0
+    return len(str(sexpr))
+
+
+def _get_snapshot_size(snapshot):
+    if isinstance(snapshot, tuple):
+        return sum(_get_sexpr_size(sexpr) for sexpr in snapshot)
+    return _get_sexpr_size(snapshot)
+
+
+class _Step(object):
+    """
+    One undoable action: a list of (key, snapshot) pairs, where key is
+    a (kind, page number) pair.
+    """
+
+    def __init__(self):
+        self.items = []
+        self.size = 0
+
+    def add(self, key, snapshot, size):
+        self.items += [(key, snapshot)]
+        self.size += size
+
+    @property
+    def page_no(self):
+        for (kind, n), snapshot in self.items:
+            if n is not None and n >= 0:
+                return n
+
+
+class _TextCallback(text.PageTextCallback):
+    def __init__(self, history, n, model):
+        self._history = history
+        self._n = n
+        self._model = weakref.ref(model)
+
+    def _record(self, size):
+        self._history._record(("txt", self._n), self._model(), size)
+
+    def notify_node_change(self, node):
+        self._record(_get_path_size(node))
+
+    def notify_node_children_change(self, node):
+        self._record(None)
+
+    def notify_tree_change(self, node):
+        self._record(None)
+
+    def notify_node_select(self, node):
+        pass
+
+    def notify_node_deselect(self, node):
+        pass
+
+
+class _AnnotationsCallback(annotations.PageAnnotationsCallback):
+    def __init__(self, history, n, model):
+        self._history = history
+        self._n = n
+        self._model = weakref.ref(model)
+        # Mapareas don't cache their s-expressions:
+        self._sexprs = weakref.WeakKeyDictionary()
+
+    def get_snapshot(self):
+        sexprs = self._sexprs
+        snapshot = []
+        for node in self._model().mapareas:
+            sexpr = sexprs.get(node)
+            if sexpr is None:
+                sexpr = sexprs[node] = node.sexpr
+            snapshot += [sexpr]
+        return tuple(snapshot)
+
+    def set_snapshot(self, snapshot):
+        self._sexprs.update(zip(self._model().mapareas, snapshot))
+
+    def _record(self, size):
+        self._history._record(("ant", self._n), self._model(), size)
+
+    def notify_node_change(self, node):
+        self._sexprs.pop(node, None)
+        self._record(_get_sexpr_size(node.sexpr))
+
+    def notify_node_add(self, node):
+        self._record(_get_sexpr_size(node.sexpr))
+
+    def notify_node_delete(self, node):
+        self._record(_LINK_SIZE)
+
+    def notify_node_replace(self, node, other_node):
+        self._record(_get_sexpr_size(other_node.sexpr))
+
+    def notify_mapareas_change(self):
+        self._record(None)
+
+    def notify_node_select(self, node):
+        pass
+
+    def notify_node_deselect(self, node):
+        pass
+
+
+class _OutlineCallback(outline.OutlineCallback):
+    def __init__(self, history, model):
+        self._history = history
+        self._model = model
+
+    def notify_tree_change(self, node):
+        self._history._record(("outline", None), self._model, None)
+
+    def notify_node_change(self, node):
+        self._history._record(("outline", None), self._model, _get_path_size(node))
+
+    def notify_node_children_change(self, node):
+        self._history._record(("outline", None), self._model, None)
+
+    def notify_node_select(self, node):
+        pass
+
+
+class History(object):
+    """
+    Undo/redo history of text, annotations, metadata and outline.
+
+    The snapshots take at most about `max_size` bytes (`None` means no
+    limit), but the most recent step is always kept.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self._undo = []
+        self._redo = []
+        self._size = 0
+        self._group = None
+        self._group_depth = 0
+        self._restoring = False
+        self._models = {}
+        # The most recent snapshots of the models. Unmodified page models can
+        # be evicted from the caches, so they mustn't be kept alive here:
+        self._current = weakref.WeakKeyDictionary()
+        # Metadata models are replaced rather than modified, so their
+        # snapshots are indexed by page numbers:
+        self._current_metadata = {}
+        # Models keep only weak references to their callbacks:
+        self._callbacks = weakref.WeakKeyDictionary()
+        self._outline_callback = None
+
+    @property
+    def size(self):
+        """
+        Estimated memory taken by the snapshots, in bytes.
+        """
+        return self._size
+
+    def can_undo(self):
+        return bool(self._undo)
+
+    def can_redo(self):
+        return bool(self._redo)
+
+    def attach(self, text_model, annotations_model, metadata_model, outline_model):
+        """
+        Record changes of the models from now on.
+        """
+        self._models = dict(
+            txt=text_model,
+            ant=annotations_model,
+            meta=metadata_model,
+            outline=outline_model,
+        )
+
+        def text_hook(n, model):
+            self._current[model] = model.raw_value
+            callback = _TextCallback(self, n, model)
+            self._callbacks[model] = callback
+            model.register_callback(callback)
+
+        def annotations_hook(n, model):
+            callback = _AnnotationsCallback(self, n, model)
+            self._current[model] = callback.get_snapshot()
+            self._callbacks[model] = callback
+            model.register_callback(callback)
+
+        def metadata_hook(n, model):
+            snapshot = dict(model)
+            old_snapshot = self._current_metadata.get(n)
+            self._current_metadata[n] = snapshot
+            if self._restoring or old_snapshot is None or old_snapshot == snapshot:
+                return
+            size = sum(len(key) + len(value) for key, value in snapshot.items())
+            self._push(("meta", n), old_snapshot, size)
+
+        text_model.add_page_hook(text_hook)
+        annotations_model.add_page_hook(annotations_hook)
+        metadata_model.add_page_hook(metadata_hook)
+        self._current[outline_model] = outline_model.raw_value
+        self._outline_callback = _OutlineCallback(self, outline_model)
+        outline_model.register_callback(self._outline_callback)
+
+    def _record(self, key, model, size):
+        if self._restoring:
+            return
+        try:
+            old_snapshot = self._current[model]
+        except KeyError:
+            return
+        if key[0] == "ant":
+            snapshot = self._callbacks[model].get_snapshot()
+        else:
+            snapshot = model.raw_value
+        if size is None:
+            # The stored snapshot shares nothing with the new state.
+            size = _get_snapshot_size(old_snapshot)
+        self._current[model] = snapshot
+        self._push(key, old_snapshot, size)
+
+    def _push(self, key, snapshot, size):
+        for step in self._redo:
+            self._size -= step.size
+        self._redo = []
+        if self._group is not None:
+            self._group.add(key, snapshot, size)
+            return
+        step = _Step()
+        step.add(key, snapshot, size)
+        self._add_undo_step(step)
+
+    def _add_undo_step(self, step):
+        self._undo += [step]
+        self._size += step.size
+        if self.max_size is None:
+            return
+        while self._size > self.max_size and len(self._undo) > 1:
+            self._size -= self._undo.pop(0).size
+
+    @contextlib.contextmanager
+    def group(self):
+        """
+        Make changes within the block undoable as a single step.
+        """
+        if self._group_depth == 0:
+            self._group = _Step()
+        self._group_depth += 1
+        try:
+            yield
+        finally:
+            self._group_depth -= 1
+            if self._group_depth == 0:
+                step = self._group
+                self._group = None
+                if step.items:
+                    self._add_undo_step(step)
+
+    def _restore(self, key, snapshot):
+        """
+        Restore the snapshot; return the snapshot of the replaced state.
+        """
+        kind, n = key
+        if kind == "txt":
+            model = self._models[kind][n]
+            old_snapshot = model.raw_value
+            model.raw_value = snapshot
+            self._current[model] = snapshot
+        elif kind == "ant":
+            model = self._models[kind][n]
+            callback = self._callbacks[model]
+            old_snapshot = callback.get_snapshot()
+            with model.batch():
+                for node in list(model.mapareas):
+                    model.remove_maparea(node)
+                for sexpr in snapshot:
+                    model.add_maparea(annotations.MapArea.from_sexpr(sexpr, model))
+            callback.set_snapshot(snapshot)
+            self._current[model] = snapshot
+        elif kind == "meta":
+            old_model = self._models[kind][n]
+            old_snapshot = dict(old_model)
+            model = old_model.clone()
+            model.replace_all(snapshot)
+            self._models[kind][n] = model
+        elif kind == "outline":
+            model = self._models[kind]
+            old_snapshot = model.raw_value
+            model.raw_value = snapshot
+            self._current[model] = snapshot
+        else:
+            raise ValueError(kind)
+        return old_snapshot
+
+    def _apply(self, step):
+        reverse_step = _Step()
+        self._restoring = True
+        try:
+            for key, snapshot in reversed(step.items):
+                old_snapshot = self._restore(key, snapshot)
+                reverse_step.items[:0] = [(key, old_snapshot)]
+        finally:
+            self._restoring = False
+        reverse_step.size = step.size
+        return reverse_step
+
+    def undo(self):
+        """
+        Undo the most recent step. Return number of the affected page, or
+        None.
+        """
+        if not self._undo:
+            return
+        step = self._undo.pop()
+        self._redo += [self._apply(step)]
+        return step.page_no
+
+    def redo(self):
+        """
+        Redo the most recently undone step. Return number of the affected
+        page, or None.
+        """
+        if not self._redo:
+            return
+        step = self._redo.pop()
+        self._undo += [self._apply(step)]
+        return step.page_no
+
+    def clear(self):
+        self._undo = []
+        self._redo = []
+        self._size = 0
+
+
+__all__ = ["History"]
+
+# vim:ts=4 sts=4 sw=4 et
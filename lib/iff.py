@@ -0,0 +1,668 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2019 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+"""
+Native reading and writing of DjVu (IFF85) files.
+
+See Lizardtech DjVu Reference (DjVu 3):
+- 8.1 Overview of the Structure of DjVu Files.
+- 8.3.4 Annotation Chunk.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+from djvusmooth import config
+
+MAGIC = b"AT&T"
+
+ANNOTATION_CHUNK_IDS = frozenset([b"ANTa", b"ANTz"])
+
+
+class FormatError(ValueError):
+    pass
+
+
+class NotSupported(Exception):
+    """
+    The requested change cannot be made without djvused.
+    """
+
+
+class Chunk(object):
+    def __init__(self, id, offset, size, form_type=None):
+        self.id = id
+        self.offset = offset
+        self.size = size
+        self.form_type = form_type
+        self.children = None
+
+    @property
+    def data_offset(self):
+        return self.offset + 8
+
+    @property
+    def padded_size(self):
+        return self.size + (self.size & 1)
+
+    @property
+    def end(self):
+        return self.data_offset + self.padded_size
+
+    def is_form(self, form_type=None):
+        if self.id != b"FORM":
+            return False
+        return form_type is None or self.form_type == form_type
+
+    def __repr__(self):
+        id = self.id.decode("ASCII", "replace")
+        if self.form_type is not None:
+            id += ":" + self.form_type.decode("ASCII", "replace")
+        return "{mod}.{cls}({id}, offset={offset}, size={size})".format(
+            mod=self.__module__,
+            cls=type(self).__name__,
+            id=id,
+            offset=self.offset,
+            size=self.size,
+        )
+
+
+def _read_exactly(fp, offset, size):
+    fp.seek(offset)
+    data = fp.read(size)
+    if len(data) != size:
+        raise FormatError("unexpected end of file")
+    return data
+
+
+def read_chunks(fp, start, end):
+    """
+    Read headers of the chunks that occupy the given part of the file.
+    """
+    result = []
+    offset = start
+    while offset + 8 <= end:
+        id, size = struct.unpack(">4sI", _read_exactly(fp, offset, 8))
+        chunk = Chunk(id, offset, size)
+        if chunk.end > end + 1:
+            # (The padding byte of the last chunk is sometimes missing.)
+            raise FormatError("chunk {id!r} is truncated".format(id=id))
+        if id == b"FORM":
+            chunk.form_type = _read_exactly(fp, chunk.data_offset, 4)
+        result += [chunk]
+        offset = chunk.end
+    return result
+
+
+def read_form_children(fp, form):
+    """
+    Read headers of the chunks contained in the FORM chunk.
+    """
+    if form.children is None:
+        end = form.data_offset + form.size
+        form.children = read_chunks(fp, form.data_offset + 4, end)
+    return form.children
+
+
+def read_file(fp):
+    """
+    Read the top-level FORM chunk, and the headers of its children.
+    """
+    fp.seek(0, os.SEEK_END)
+    file_size = fp.tell()
+    if _read_exactly(fp, 0, 4) != MAGIC:
+        raise FormatError("not a DjVu file")
+    [form] = read_chunks(fp, 4, file_size)[:1] or [None]
+    if form is None or not form.is_form():
+        raise FormatError("not a DjVu file")
+    read_form_children(fp, form)
+    return form
+
+
+def _copy_range(src_fd, dst_fd, offset, size):
+    """
+    Copy a part of one file to the current position of another one,
+    without passing the data through the user space, if possible.
+    """
+    copiers = []
+    try:
+        copiers += [os.copy_file_range]
+    except AttributeError:
+        pass
+    try:
+        sendfile = os.sendfile
+    except AttributeError:
+        pass
+    else:
+        copiers += [lambda src, dst, count, offset: sendfile(dst, src, offset, count)]
+    while size > 0:
+        n = 0
+        while copiers:
+            copier = copiers[0]
+            try:
+                n = copier(src_fd, dst_fd, size, offset)
+            except OSError:
+                # Not supported for these kinds of files.
+                del copiers[0]
+                continue
+            break
+        if not copiers:
+            data = os.pread(src_fd, min(size, 1 << 20), offset)
+            n = os.write(dst_fd, data)
+        if n <= 0:
+            raise FormatError("unexpected end of file")
+        offset += n
+        size -= n
+
+
+def _chunk_header(id, size):
+    return struct.pack(">4sI", id, size)
+
+
+def _annotation_chunk(data):
+    result = _chunk_header(b"ANTa", len(data)) + data
+    if len(data) & 1:
+        result += b"\0"
+    return result
+
+
+def rewrite_annotations(path, data):
+    """
+    Replace annotations of a single-page DjVu file, copying the other chunks
+    verbatim. The file is replaced atomically.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    with open(path, "rb") as fp:
+        form = read_file(fp)
+        if not form.is_form(b"DJVU"):
+            raise NotSupported
+        children = form.children
+        old_annotations = [
+            i for i, chunk in enumerate(children) if chunk.id in ANNOTATION_CHUNK_IDS
+        ]
+        if old_annotations:
+            position = old_annotations[0]
+        else:
+            # Put the annotations right after the INFO and INCL chunks:
+            position = 0
+            while position < len(children) and children[position].id in (
+                b"INFO",
+                b"INCL",
+            ):
+                position += 1
+        new_chunk = _annotation_chunk(data) if data else b""
+        kept = [chunk for chunk in children if chunk.id not in ANNOTATION_CHUNK_IDS]
+        n_before = len([chunk for chunk in children[:position] if chunk in kept])
+        form_size = 4 + len(new_chunk) + sum(8 + chunk.padded_size for chunk in kept)
+        with tempfile.NamedTemporaryFile(
+            dir=directory, prefix=".djvusmooth.", delete=False
+        ) as tmp_file:
+            try:
+                tmp_file.write(MAGIC + _chunk_header(b"FORM", form_size) + b"DJVU")
+                tmp_file.flush()
+                src_fd = fp.fileno()
+                dst_fd = tmp_file.fileno()
+                for i, chunk in enumerate(kept):
+                    if i == n_before:
+                        os.write(dst_fd, new_chunk)
+                    if chunk.end > form.data_offset + form.size:
+                        # Missing padding byte:
+                        _copy_range(src_fd, dst_fd, chunk.offset, 8 + chunk.size)
+                        os.write(dst_fd, b"\0")
+                    else:
+                        _copy_range(src_fd, dst_fd, chunk.offset, 8 + chunk.padded_size)
+                if n_before == len(kept):
+                    os.write(dst_fd, new_chunk)
+                os.fsync(dst_fd)
+                shutil.copymode(path, tmp_file.name)
+            except BaseException:
+                os.unlink(tmp_file.name)
+                raise
+    os.rename(tmp_file.name, path)
+
+
+def _get_cache_path(kind, path, suffix):
+    directory = config.xdg.save_cache_path("djvusmooth")
+    directory = os.path.join(directory, kind)
+    try:
+        os.mkdir(directory, 0o700)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+    path = os.path.abspath(os.fsdecode(path))
+    digest = hashlib.sha1(path.encode("UTF-8", "surrogateescape"))
+    return os.path.join(directory, digest.hexdigest() + suffix)
+
+
+def get_undo_record_path(path):
+    return _get_cache_path("undo", path, ".undo")
+
+
+# The undo record consists of a header identifying the file (device, inode,
+# size), followed by items: offset, size and digest of the new data, and the
+# old data.
+_UNDO_HEADER = struct.Struct(">QQQ")
+_UNDO_ITEM_HEADER = struct.Struct(">QI20s")
+
+
+def _get_file_id(fd):
+    st = os.fstat(fd)
+    return st.st_dev, st.st_ino, st.st_size
+
+
+def _fsync_directory(path):
+    fd = os.open(os.path.dirname(path), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _parse_undo_record(record):
+    file_id = _UNDO_HEADER.unpack_from(record, 0)
+    position = _UNDO_HEADER.size
+    items = []
+    while position < len(record):
+        offset, size, new_digest = _UNDO_ITEM_HEADER.unpack_from(record, position)
+        position += _UNDO_ITEM_HEADER.size
+        old_data = record[position : position + size]
+        if len(old_data) != size:
+            raise ValueError
+        position += size
+        items += [(offset, old_data, new_digest)]
+    return file_id, items
+
+
+def recover(path):
+    """
+    Restore parts of the file overwritten by an interrupted patch_file(),
+    if any. Return whether anything was restored.
+
+    The record is discarded without restoring anything if the file is not the
+    one that was being patched (e.g. it has been replaced since), or if the
+    patching actually completed.
+    """
+    try:
+        undo_path = get_undo_record_path(path)
+        with open(undo_path, "rb") as undo_file:
+            record = undo_file.read()
+    except (IOError, OSError):
+        return False
+    restored = False
+    try:
+        file_id, items = _parse_undo_record(record)
+    except (struct.error, ValueError):
+        items = None
+    if items is not None and os.path.exists(path):
+        with open(path, "r+b") as fp:
+            fd = fp.fileno()
+            if _get_file_id(fd) == file_id:
+                current_digests = [
+                    hashlib.sha1(os.pread(fd, len(old_data), offset)).digest()
+                    for offset, old_data, new_digest in items
+                ]
+                new_digests = [new_digest for offset, old_data, new_digest in items]
+                if current_digests != new_digests:
+                    for offset, old_data, new_digest in items:
+                        os.pwrite(fd, old_data, offset)
+                    os.fsync(fd)
+                    restored = True
+    os.unlink(undo_path)
+    return restored
+
+
+def patch_file(path, patches):
+    """
+    Overwrite parts of the file with the provided data, in place.
+
+    The original contents of these parts are saved in an undo record (in the
+    user's cache directory) first, so that recover() can restore them if
+    patching is interrupted. Raise NotSupported if the record can't be
+    written; in this case the file is left untouched.
+    """
+    recover(path)
+    with open(path, "r+b") as fp:
+        fd = fp.fileno()
+        record = [_UNDO_HEADER.pack(*_get_file_id(fd))]
+        for offset, data in patches:
+            old_data = os.pread(fd, len(data), offset)
+            if len(old_data) != len(data):
+                raise FormatError("unexpected end of file")
+            new_digest = hashlib.sha1(data).digest()
+            record += [_UNDO_ITEM_HEADER.pack(offset, len(data), new_digest), old_data]
+        try:
+            undo_path = get_undo_record_path(path)
+            directory, base_name = os.path.split(undo_path)
+            with tempfile.NamedTemporaryFile(
+                dir=directory, prefix=base_name + ".", delete=False
+            ) as undo_file:
+                try:
+                    undo_file.write(b"".join(record))
+                    undo_file.flush()
+                    os.fsync(undo_file.fileno())
+                except BaseException:
+                    os.unlink(undo_file.name)
+                    raise
+            os.rename(undo_file.name, undo_path)
+            _fsync_directory(undo_path)
+        except (IOError, OSError):
+            raise NotSupported
+        for offset, data in patches:
+            os.pwrite(fd, data, offset)
+        os.fsync(fd)
+    os.unlink(undo_path)
+
+
+class ChunkIndex(object):
+    """
+    Structural index of a DjVu file: location of the top-level chunks, and of
+    the interesting chunks inside each component, and ids of the components
+    holding the pages.
+
+    The DIRM chunk is BZZ-compressed, so the component ids are not decoded
+    here; they are supplied by the caller (see `set_page_ids()`) and then
+    remembered along with the chunks.
+
+    The index is cached in the user's cache directory, and is valid as long as
+    the file size and modification time don't change.
+    """
+
+    _version = 1
+
+    INDEXED_CHUNK_IDS = frozenset(
+        [b"INFO", b"INCL", b"ANTa", b"ANTz", b"TXTa", b"TXTz", b"NAVM", b"DIRM"]
+    )
+
+    def __init__(self, path, stamp, form, page_ids=None):
+        self._path = path
+        self._stamp = stamp
+        self._form = form
+        self._pages = None
+        self._page_ids = page_ids
+
+    @staticmethod
+    def _get_stamp(path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns]
+
+    @staticmethod
+    def get_cache_path(path):
+        return _get_cache_path("index", path, ".json")
+
+    @classmethod
+    def build(cls, path):
+        stamp = cls._get_stamp(path)
+        with open(path, "rb") as fp:
+            try:
+                buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise FormatError("not a DjVu file")
+            try:
+                form = read_file(buffer)
+                for component in form.children:
+                    if component.is_form():
+                        read_form_children(buffer, component)
+                        component.children = [
+                            chunk
+                            for chunk in component.children
+                            if chunk.id in cls.INDEXED_CHUNK_IDS
+                        ]
+            finally:
+                buffer.close()
+        return cls(path, stamp, form)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Return index of the file, either cached, or freshly built.
+        """
+        path = os.fsdecode(path)
+        stamp = cls._get_stamp(path)
+        try:
+            cache_path = cls.get_cache_path(path)
+            with open(cache_path, "r") as file:
+                data = json.load(file)
+            if data["version"] == cls._version and data["stamp"] == stamp:
+                return cls(
+                    path,
+                    stamp,
+                    _chunk_from_json(data["form"]),
+                    data.get("page_ids"),
+                )
+        except (IOError, OSError, ValueError, LookupError, TypeError):
+            pass
+        self = cls.build(path)
+        self.save()
+        return self
+
+    def save(self):
+        data = dict(
+            version=self._version,
+            stamp=self._stamp,
+            form=_chunk_to_json(self._form),
+            page_ids=self._page_ids,
+        )
+        try:
+            cache_path = self.get_cache_path(self._path)
+            directory, base_name = os.path.split(cache_path)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=directory, prefix=base_name + ".", delete=False
+            ) as file:
+                try:
+                    json.dump(data, file)
+                except BaseException:
+                    os.unlink(file.name)
+                    raise
+            os.rename(file.name, cache_path)
+        except (IOError, OSError):
+            # The cache is merely an optimization.
+            pass
+
+    @property
+    def form(self):
+        return self._form
+
+    @property
+    def form_type(self):
+        return self._form.form_type
+
+    @property
+    def pages(self):
+        """
+        Components of a bundled document that are pages, in the page order.
+        """
+        if self._pages is None:
+            if self._form.is_form(b"DJVU"):
+                self._pages = [self._form]
+            else:
+                self._pages = [
+                    chunk for chunk in self._form.children if chunk.is_form(b"DJVU")
+                ]
+        return self._pages
+
+    @property
+    def page_ids(self):
+        """
+        Ids of the components holding the pages, in the page order; or `None`
+        if they are not known yet.
+        """
+        return self._page_ids
+
+    def set_page_ids(self, ids):
+        self._page_ids = list(ids)
+        self.save()
+
+    def is_bundled(self):
+        return self._form.is_form(b"DJVM") and bool(self.pages)
+
+    def is_indirect(self):
+        return self._form.is_form(b"DJVM") and not self.pages
+
+    def get_chunks(self, component, ids):
+        ids = frozenset(ids)
+        return [chunk for chunk in component.children if chunk.id in ids]
+
+    def get_page_chunks(self, page_no, ids):
+        return self.get_chunks(self.pages[page_no], ids)
+
+
+def _chunk_to_json(chunk):
+    result = [chunk.id.decode("ASCII"), chunk.offset, chunk.size]
+    if chunk.form_type is not None:
+        result += [chunk.form_type.decode("ASCII")]
+        if chunk.children is not None:
+            result += [[_chunk_to_json(child) for child in chunk.children]]
+    return result
+
+
+def _chunk_from_json(data):
+    id, offset, size = data[:3]
+    chunk = Chunk(id.encode("ASCII"), offset, size)
+    if len(data) > 3:
+        chunk.form_type = data[3].encode("ASCII")
+    if len(data) > 4:
+        chunk.children = [_chunk_from_json(child) for child in data[4]]
+    return chunk
+
+
+def _plan_patch(index, page_no, data):
+    """
+    Find a way to store the annotations in the existing annotation chunks of
+    the page, without changing size of any of them.
+    """
+    try:
+        chunks = index.get_page_chunks(page_no, ANNOTATION_CHUNK_IDS)
+    except IndexError:
+        raise NotSupported
+    if not chunks:
+        raise NotSupported
+    target = max(chunks, key=lambda chunk: chunk.size)
+    if target.size < len(data):
+        raise NotSupported
+    result = []
+    for chunk in chunks:
+        if chunk is target:
+            content = data.ljust(chunk.size, b" ")
+        else:
+            content = b" " * chunk.size
+        result += [(chunk.offset, _chunk_header(b"ANTa", chunk.size) + content)]
+    return result
+
+
+class NativeEditor(object):
+    """
+    A partial replacement for djvused.StreamEditor that rewrites only the
+    chunks that changed.
+
+    Only page annotations are supported; `NotSupported` is raised for
+    anything else, either immediately or when committing (before anything is
+    written to disk).
+
+    `page_files` should map page numbers to component file names for indirect
+    documents. `extra_annotations` should return annotations that the model
+    doesn't know of (such as metadata) for the page number, so that they are
+    preserved, or `None` if they are not known.
+    """
+
+    def __init__(self, file_name, page_files=None, extra_annotations=None):
+        self._file_name = os.fsdecode(file_name)
+        self._page_files = page_files
+        self._extra_annotations = extra_annotations
+        self._selected = None
+        self._annotations = {}
+
+    def _not_supported(self, *args, **kwargs):
+        raise NotSupported
+
+    select_all = _not_supported
+    select_shared_annotations = create_shared_annotations = _not_supported
+    remove_annotations = _not_supported
+    set_metadata = remove_metadata = _not_supported
+    set_text = remove_text = _not_supported
+    set_outline = _not_supported
+    set_thumbnails = remove_thumbnails = _not_supported
+    set_page_title = _not_supported
+
+    def select(self, page_id):
+        if not isinstance(page_id, int):
+            raise NotSupported
+        self._selected = page_id - 1
+
+    def set_annotations(self, annotations):
+        page_no = self._selected
+        if page_no is None:
+            raise NotSupported
+        annotations = list(annotations)
+        if self._extra_annotations is not None:
+            extra = self._extra_annotations(page_no)
+        else:
+            extra = None
+        if extra is None:
+            raise NotSupported
+        annotations += extra
+        data = "\n".join(str(annotation) for annotation in annotations)
+        self._annotations[page_no] = data.encode("UTF-8")
+
+    def commit(self):
+        if not self._annotations:
+            return
+        index = ChunkIndex.load(self._file_name)
+        if index.form_type == b"DJVU":
+            if set(self._annotations) != set([0]):
+                raise NotSupported
+            rewrite_annotations(self._file_name, self._annotations[0])
+        elif index.is_indirect():
+            # Each page has its own file.
+            if self._page_files is None:
+                raise NotSupported
+            page_files = dict(
+                (page_no, self._page_files(page_no)) for page_no in self._annotations
+            )
+            for page_no, data in sorted(self._annotations.items()):
+                rewrite_annotations(page_files[page_no], data)
+        elif index.is_bundled():
+            patches = []
+            for page_no, data in sorted(self._annotations.items()):
+                patches += _plan_patch(index, page_no, data)
+            patch_file(self._file_name, patches)
+            # Chunk sizes didn't change, so the index needs only a little update.
+            for page_no in self._annotations:
+                for chunk in index.get_page_chunks(page_no, ANNOTATION_CHUNK_IDS):
+                    chunk.id = b"ANTa"
+            index._stamp = index._get_stamp(self._file_name)
+            index.save()
+        else:
+            raise NotSupported
+
+
+__all__ = [
+    "ChunkIndex",
+    "NativeEditor",
+    "NotSupported",
+    "FormatError",
+    "read_file",
+    "read_chunks",
+    "read_form_children",
+    "patch_file",
+    "recover",
+    "rewrite_annotations",
+]
+
+# vim:ts=4 sts=4 sw=4 et
@@ -0,0 +1,429 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2019 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+"""
+Append-only journal of unsaved changes, to recover from crashes.
+
+The journal is a file of JSON records, one per line. The first one identifies
+the document, the other ones describe modifications of the models:
+
+- ``txt-node``: text or rectangle of a single text zone changed;
+- ``txt``: text of the whole page changed;
+- ``ant``: list of page hyperlinks changed;
+- ``meta``: page or document metadata changed;
+- ``outline``: document outline changed.
+
+Only ``txt-node`` records describe a single change. The other kinds hold the
+whole new state, so they are not written on every change: the state of each
+modified page is written at most once per flush interval, when `flush()` is
+called, or when the journal is closed.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import time
+import weakref
+
+import djvu.sexpr
+
+from djvusmooth import config
+from djvusmooth.models import annotations
+from djvusmooth.models import outline
+from djvusmooth.models import text
+
+
+def get_journal_directory():
+    path = config.xdg.save_state_path("djvusmooth")
+    path = os.path.join(path, "journal")
+    try:
+        os.mkdir(path, 0o700)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    return path
+
+
+def _get_stamp(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _sexpr_to_json(sexpr):
+    if sexpr is None:
+        return None
+    return str(sexpr)
+
+
+def _sexpr_from_json(value):
+    if value is None:
+        return None
+    return djvu.sexpr.Expression.from_string(value)
+
+
+def _get_node_path(node):
+    path = []
+    while True:
+        try:
+            parent = node.parent
+        except StopIteration:
+            break
+        path += [list(parent).index(node)]
+        node = parent
+    path.reverse()
+    return path
+
+
+class _TextCallback(text.PageTextCallback):
+    def __init__(self, journal, n, model):
+        self._journal = journal
+        self._n = n
+        self._model = weakref.ref(model)
+
+    def notify_node_change(self, node):
+        record = dict(path=_get_node_path(node), rect=[node.x, node.y, node.w, node.h])
+        if node.is_leaf():
+            record.update(text=node.text)
+        self._journal.record("txt-node", self._n, **record)
+
+    def notify_node_children_change(self, node):
+        self.notify_tree_change(node)
+
+    def notify_tree_change(self, node):
+        self._journal.record_state("txt", self._n, self._get_state)
+
+    def _get_state(self):
+        model = self._model()
+        if model is None:
+            return None
+        return dict(sexpr=_sexpr_to_json(model.raw_value))
+
+    def notify_node_select(self, node):
+        pass
+
+    def notify_node_deselect(self, node):
+        pass
+
+
+class _AnnotationsCallback(annotations.PageAnnotationsCallback):
+    def __init__(self, journal, n, model):
+        self._journal = journal
+        self._n = n
+        self._model = weakref.ref(model)
+
+    def _record(self):
+        self._journal.record_state("ant", self._n, self._get_state)
+
+    def _get_state(self):
+        model = self._model()
+        if model is None:
+            return None
+        return dict(mapareas=[str(node.sexpr) for node in model.mapareas])
+
+    def notify_node_change(self, node):
+        self._record()
+
+    def notify_node_add(self, node):
+        self._record()
+
+    def notify_node_delete(self, node):
+        self._record()
+
+    def notify_node_replace(self, node, other_node):
+        self._record()
+
+    def notify_mapareas_change(self):
+        self._record()
+
+    def notify_node_select(self, node):
+        pass
+
+    def notify_node_deselect(self, node):
+        pass
+
+
+class _OutlineCallback(outline.OutlineCallback):
+    def __init__(self, journal, model):
+        self._journal = journal
+        self._model = model
+
+    def _record(self):
+        self._journal.record_state("outline", None, self._get_state)
+
+    def _get_state(self):
+        return dict(sexpr=_sexpr_to_json(self._model.raw_value))
+
+    def notify_tree_change(self, node):
+        self._record()
+
+    def notify_node_change(self, node):
+        self._record()
+
+    def notify_node_children_change(self, node):
+        self._record()
+
+    def notify_node_select(self, node):
+        pass
+
+
+class Journal(object):
+    _sync_interval = 1.0  # seconds
+    flush_interval = 1.0  # seconds
+
+    # Records of these kinds are superseded by the state of the whole page:
+    _STATE_KINDS = {"txt-node": "txt"}
+
+    def __init__(self, document_path):
+        self._document_path = os.path.abspath(os.fsdecode(document_path))
+        digest = hashlib.sha1(self._document_path.encode("UTF-8", "surrogateescape"))
+        self._path = os.path.join(
+            get_journal_directory(), digest.hexdigest() + ".journal"
+        )
+        self._file = None
+        self._last_sync = 0
+        self._last_flush = 0
+        # (kind, page number) → function returning the current state:
+        self._pending = {}
+        self._suspended = False
+        self._keep = False
+        # Models keep only weak references to their callbacks:
+        self._callbacks = weakref.WeakKeyDictionary()
+        self._outline_callback = None
+
+    @property
+    def path(self):
+        return self._path
+
+    def read(self):
+        """
+        Return records left by a previous session for this document, or an
+        empty list if there are none, or if the document has changed since.
+        """
+        try:
+            file = open(self._path, "r", encoding="UTF-8")
+        except (IOError, OSError):
+            return []
+        with file:
+            records = []
+            try:
+                header = json.loads(file.readline())
+                if header.get("path") != self._document_path:
+                    return []
+                if header.get("stamp") != _get_stamp(self._document_path):
+                    return []
+                for line in file:
+                    if not line.endswith("\n"):
+                        # Partially written record.
+                        break
+                    records += [json.loads(line)]
+            except (OSError, ValueError, AttributeError):
+                pass
+            return records
+
+    def _open(self, keep):
+        if keep and os.path.exists(self._path):
+            self._file = open(self._path, "a", encoding="UTF-8")
+            return
+        self._file = open(self._path, "w", encoding="UTF-8")
+        header = dict(path=self._document_path, stamp=_get_stamp(self._document_path))
+        self._write(header)
+
+    def _write(self, data):
+        self._file.write(json.dumps(data, ensure_ascii=False) + "\n")
+        self._file.flush()
+        now = time.time()
+        if now - self._last_sync >= self._sync_interval:
+            os.fsync(self._file.fileno())
+            self._last_sync = now
+
+    def start(self, keep=False):
+        """
+        Start recording. If `keep` is true, the records from the previous
+        session are preserved.
+        """
+        self._pending.clear()
+        self._close_file()
+        if not keep:
+            self._remove()
+        self._keep = keep
+
+    def _emit(self, data):
+        try:
+            if self._file is None:
+                self._open(self._keep)
+            self._write(data)
+        except (IOError, OSError):
+            # The journal is merely a safety net; don't let it get in the way
+            # of editing.
+            self._pending.clear()
+            self._close_file()
+            self._suspended = True
+
+    def record(self, kind, n, **data):
+        """
+        Record a single change.
+        """
+        if self._suspended:
+            return
+        if (self._STATE_KINDS.get(kind), n) in self._pending:
+            # The whole state will be recorded anyway.
+            return
+        data.update(kind=kind, n=n)
+        self._emit(data)
+
+    def record_state(self, kind, n, get_state):
+        """
+        Record the current state of the page (or of the whole document, if `n`
+        is None). `get_state()` is called when the record is written; it should
+        return a dictionary, or None if there's nothing to record.
+        """
+        if self._suspended:
+            return
+        self._pending[kind, n] = get_state
+        if time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write records of states that changed since the last flush.
+        """
+        self._last_flush = time.time()
+        pending = self._pending
+        self._pending = {}
+        for (kind, n), get_state in pending.items():
+            if self._suspended:
+                break
+            data = get_state()
+            if data is None:
+                continue
+            data.update(kind=kind, n=n)
+            self._emit(data)
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        self.flush()
+        self._close_file()
+
+    def _remove(self):
+        try:
+            os.unlink(self._path)
+        except OSError:
+            pass
+
+    def discard(self):
+        """
+        Forget all the records, e.g. because the changes were saved.
+        """
+        self._pending.clear()
+        self._close_file()
+        self._remove()
+        self._keep = False
+
+    @contextlib.contextmanager
+    def suspended(self):
+        self._suspended = True
+        try:
+            yield
+        finally:
+            self._suspended = False
+
+    def attach(self, text_model, annotations_model, metadata_model, outline_model):
+        """
+        Record changes of the models from now on.
+        """
+
+        def text_hook(n, model):
+            callback = _TextCallback(self, n, model)
+            self._callbacks[model] = callback
+            model.register_callback(callback)
+
+        def annotations_hook(n, model):
+            callback = _AnnotationsCallback(self, n, model)
+            self._callbacks[model] = callback
+            model.register_callback(callback)
+
+        def metadata_hook(n, model):
+            if model.is_dirty():
+                self.record("meta", n, value=dict(model))
+
+        text_model.add_page_hook(text_hook)
+        annotations_model.add_page_hook(annotations_hook)
+        metadata_model.add_page_hook(metadata_hook)
+        self._outline_callback = _OutlineCallback(self, outline_model)
+        outline_model.register_callback(self._outline_callback)
+
+    def replay(
+        self, records, text_model, annotations_model, metadata_model, outline_model
+    ):
+        """
+        Apply the records to the models.
+        """
+        with self.suspended():
+            for record in records:
+                try:
+                    self._replay_record(
+                        record,
+                        text_model,
+                        annotations_model,
+                        metadata_model,
+                        outline_model,
+                    )
+                except (
+                    LookupError,
+                    TypeError,
+                    ValueError,
+                    djvu.sexpr.ExpressionSyntaxError,
+                ):
+                    # Damaged or unexpected record. Recover as much as possible.
+                    continue
+
+    def _replay_record(
+        self, record, text_model, annotations_model, metadata_model, outline_model
+    ):
+        kind = record["kind"]
+        n = record["n"]
+        if kind == "txt-node":
+            node = text_model[n].root
+            for i in record["path"]:
+                node = node[i]
+            node.x, node.y, node.w, node.h = record["rect"]
+            if "text" in record:
+                node.text = record["text"]
+        elif kind == "txt":
+            text_model[n].raw_value = _sexpr_from_json(record["sexpr"])
+        elif kind == "ant":
+            model = annotations_model[n]
+            with model.batch():
+                for node in list(model.mapareas):
+                    model.remove_maparea(node)
+                for item in record["mapareas"]:
+                    node = annotations.MapArea.from_sexpr(_sexpr_from_json(item), model)
+                    model.add_maparea(node)
+        elif kind == "meta":
+            model = metadata_model[n].clone()
+            model.replace_all(record["value"])
+            metadata_model[n] = model
+        elif kind == "outline":
+            outline_model.raw_value = _sexpr_from_json(record["sexpr"])
+
+
+__all__ = ["Journal"]
+
+# vim:ts=4 sts=4 sw=4 et
@@ -13,33 +13,337 @@
 # FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
 # more details.
 
+import collections
+import contextlib
+import hashlib
+import threading
+import weakref
+
+from apply import apply
+
 SHARED_ANNOTATIONS_PAGENO = -1
 
 
+def get_sexpr_digest(sexprs):
+    """
+    Return a digest of serialised s-expressions.
+
+    It's used to tell whether a model that has been modified actually differs
+    from the original, e.g. because the changes were reverted by hand.
+    """
+    digest = hashlib.sha1()
+    for sexpr in sexprs:
+        digest.update(str(sexpr).encode("UTF-8", "surrogateescape"))
+        digest.update(b"\n")
+    return digest.digest()
+
+
+class BatchingModel(object):
+    """
+    Model that can defer change notifications:
+
+        with model.batch():
+            ...
+
+    Notifications about changes made within the block are sent only at its
+    end, summarised. Blocks can be nested; only the outermost one counts.
+    """
+
+    _batch_depth = 0
+
+    @contextlib.contextmanager
+    def batch(self):
+        if self._batch_depth == 0:
+            self._begin_batch()
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self._commit_batch()
+
+    def _begin_batch(self):
+        raise NotImplementedError
+
+    def _commit_batch(self):
+        raise NotImplementedError
+
+
+class PageModel(object):
+    """
+    Page model whose dirty flag can be watched: hooks added with
+    add_dirty_hook() are called as soon as the model becomes dirty.
+    """
+
+    __dirty = False
+    _dirty_hooks = ()
+
+    @apply
+    def _dirty():
+        def get(self):
+            return self.__dirty
+
+        def set(self, value):
+            was_dirty = self.__dirty
+            self.__dirty = value
+            if value and not was_dirty:
+                for hook in self._dirty_hooks:
+                    hook(self)
+
+        return property(get, set)
+
+    def add_dirty_hook(self, hook):
+        if hook not in self._dirty_hooks:
+            self._dirty_hooks += (hook,)
+
+
 class MultiPageModel(object):
+    """
+    Collection of page models, created lazily.
+
+    At most `cache_size` of them are kept (`None` means no limit). The least
+    recently used ones are evicted first; the modified ones are never evicted.
+    An evicted model that is still used elsewhere is reused, rather than
+    created anew.
+
+    Page data can be acquired in advance, possibly in other threads, with
+    `prefetch()`. Everything else must happen in a single thread.
+
+    Models that are modified after being evicted are taken back into the
+    cache, so the modifications aren't lost even if nothing else refers to the
+    models:
+
+    >>> class Page(PageModel):
+    ...     def __init__(self, n, data):
+    ...         self.data = data
+    ...     def is_dirty(self):
+    ...         return self._dirty
+    ...     def edit(self, data):
+    ...         self.data = data
+    ...         self._dirty = True
+    >>> class Pages(MultiPageModel):
+    ...     def get_page_model_class(self, n):
+    ...         return Page
+    ...     def acquire_data(self, n):
+    ...         return 'original'
+    >>> pages = Pages(cache_size=3)
+    >>> for n in range(6):
+    ...     pages[n].edit('edited')
+    >>> import gc
+    >>> _ = gc.collect()
+    >>> [pages[n].data for n in range(6)]
+    ['edited', 'edited', 'edited', 'edited', 'edited', 'edited']
+    """
+
     def get_page_model_class(self, n):
         raise NotImplementedError
 
-    def __init__(self):
-        self._pages = {}
+    def __init__(self, cache_size=None):
+        self._pages = collections.OrderedDict()
+        self._evicted = weakref.WeakValueDictionary()
+        self._preloaded = {}
+        self._prefetched = set()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self._page_hooks = []
+        self._cache_size = cache_size
+        self.hits = self.misses = self.evictions = 0
+
+    @apply
+    def cache_size():
+        def get(self):
+            return self._cache_size
+
+        def set(self, value):
+            self._cache_size = value
+            self._shrink()
+
+        return property(get, set)
+
+    def get_cache_stats(self):
+        return dict(
+            size=len(self._pages),
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+        )
+
+    def add_page_hook(self, hook):
+        """
+        Call `hook(n, model)` for every page model: for the existing ones right
+        away, and for the other ones as soon as they are created or replaced.
+        """
+        self._page_hooks += (hook,)
+        for n, model in list(self._iter_live_pages()):
+            hook(n, model)
+
+    def _iter_live_pages(self):
+        for n, model in self._pages.items():
+            yield n, model
+        for n, model in list(self._evicted.items()):
+            if n not in self._pages:
+                yield n, model
+
+    def is_loaded(self, n):
+        """
+        Return whether the model of the page exists.
+        """
+        return n in self._pages or n in self._evicted
+
+    def _install(self, n, model):
+        self._pages[n] = model
+        self._evicted.pop(n, None)
+        model.add_dirty_hook(self._pin)
+        # A prefetcher could have acquired the data in the meantime:
+        with self._lock:
+            self._preloaded.pop(n, None)
+            self._prefetched.discard(n)
+        for hook in self._page_hooks:
+            hook(n, model)
+        # The caller is likely to hold only a temporary reference:
+        self._shrink(keep=n)
+
+    def _pin(self, model):
+        """
+        Take the evicted model back into the cache, as it has been modified.
+        """
+        for n, evicted_model in list(self._evicted.items()):
+            if evicted_model is model:
+                del self._evicted[n]
+                self._pages[n] = model
+
+    def _shrink(self, keep=None):
+        if self._cache_size is None:
+            return
+        excess = len(self._pages) - max(self._cache_size, 1)
+        if excess <= 0:
+            return
+        victims = []
+        for n, model in self._pages.items():
+            if len(victims) >= excess:
+                break
+            if n != keep and not model.is_dirty():
+                victims += [n]
+        for n in victims:
+            self._evicted[n] = self._pages.pop(n)
+            self.evictions += 1
 
     def __getitem__(self, n):
-        if n not in self._pages:
+        try:
+            model = self._pages[n]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            self._pages.move_to_end(n)
+            return model
+        self.misses += 1
+        model = self._evicted.get(n)
+        if model is None:
+            try:
+                data = self._take_preloaded(n)
+            except KeyError:
+                data = self.acquire_data(n)
             cls = self.get_page_model_class(n)
-            self._pages[n] = cls(n, self.acquire_data(n))
-        return self._pages[n]
+            model = cls(n, data)
+        self._install(n, model)
+        return model
 
     def __setitem__(self, n, model):
-        self._pages[n] = model
+        self._install(n, model)
+
+    def _take_preloaded(self, n):
+        with self._lock:
+            event = self._loading.get(n)
+        if event is not None:
+            # Being prefetched right now.
+            event.wait()
+        with self._lock:
+            self._prefetched.discard(n)
+            return self._preloaded.pop(n)
+
+    def preload(self, n, data):
+        """
+        Remember already acquired data for the page, unless its model exists.
+        """
+        if self.is_loaded(n):
+            return
+        with self._lock:
+            self._preloaded.setdefault(n, data)
+
+    def prefetch(self, n):
+        """
+        Acquire data for the page, unless it's already available.
+
+        This method can be called from any thread.
+        """
+        with self._lock:
+            if n in self._loading or n in self._preloaded:
+                return
+            if n in self._pages or n in self._evicted:
+                return
+            event = self._loading[n] = threading.Event()
+        try:
+            data = self.acquire_data(n)
+            with self._lock:
+                if not self.is_loaded(n):
+                    self._preloaded.setdefault(n, data)
+                    self._prefetched.add(n)
+        finally:
+            with self._lock:
+                del self._loading[n]
+            event.set()
+
+    def forget_prefetched(self, keep=()):
+        """
+        Drop the prefetched data that hasn't been used yet, except for the
+        pages in `keep`.
+        """
+        keep = frozenset(keep)
+        with self._lock:
+            for n in self._prefetched - keep:
+                del self._preloaded[n]
+            self._prefetched &= keep
+
+    def forget_preloaded(self):
+        """
+        Drop all the preloaded and prefetched data that hasn't been used yet.
+        """
+        with self._lock:
+            self._preloaded.clear()
+            self._prefetched.clear()
 
     def acquire_data(self, n):
         return {}
 
     def export(self, djvused):
-        for id in sorted(self._pages):
-            self._pages[id].export(djvused)
+        pages = dict(self._iter_live_pages())
+        for id in sorted(pages):
+            pages[id].export(djvused)
+
+    def is_modified(self):
+        """
+        Return whether any page differs from the one saved in the document.
+        """
+        return any(model.is_modified() for n, model in self._iter_live_pages())
+
+    def mark_saved(self):
+        """
+        Acknowledge that the pages have been saved in the document.
+        """
+        for n, model in list(self._iter_live_pages()):
+            model.mark_saved()
+        # The data was acquired from the document as it was before saving:
+        self.forget_preloaded()
 
 
-__all__ = ["MultiPageModel", "SHARED_ANNOTATIONS_PAGENO"]
+__all__ = [
+    "MultiPageModel",
+    "PageModel",
+    "BatchingModel",
+    "SHARED_ANNOTATIONS_PAGENO",
+    "get_sexpr_digest",
+]
 
 # vim:ts=4 sts=4 sw=4 et
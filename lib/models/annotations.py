@@ -21,6 +21,7 @@ See Lizardtech DjVu Reference (DjVu 3):
 - 8.3.4 Annotation chunk.
 """
 
+import math
 import weakref
 import itertools
 from apply import apply
@@ -29,7 +30,14 @@ import djvu.const
 import djvu.sexpr
 import djvu.decode
 
-from djvusmooth.models import MultiPageModel, SHARED_ANNOTATIONS_PAGENO
+from djvusmooth.models import (
+    MultiPageModel,
+    BatchingModel,
+    PageModel,
+    SHARED_ANNOTATIONS_PAGENO,
+    get_sexpr_digest,
+)
+from djvusmooth.models.spatial import GridIndex, rect_contains_point
 from djvusmooth.varietes import not_overridden, is_html_color
 
 
@@ -75,6 +83,13 @@ class PageAnnotationsCallback(object):
     def notify_node_replace(self, node, other_node):
         pass
 
+    @not_overridden
+    def notify_mapareas_change(self):
+        """
+        Many mapareas have been added, removed or changed at once.
+        """
+        pass
+
 
 class Border(object):
     @not_overridden
@@ -250,10 +265,10 @@ class MapArea(Annotation):
     def from_sexpr(cls, sexpr, owner):
         sexpr = iter(sexpr)
         try:
-            symbol = sexpr.next().value
+            symbol = next(sexpr).value
             if symbol is not djvu.const.ANNOTATION_MAPAREA:
                 raise MapAreaSyntaxError
-            uri = sexpr.next().value
+            uri = next(sexpr).value
             if isinstance(uri, tuple):
                 symbol, uri, target = uri
                 if symbol is not djvu.const.MAPAREA_URI:
@@ -262,10 +277,10 @@ class MapArea(Annotation):
             else:
                 target = None
             uri = uri.decode("UTF-8")
-            comment = sexpr.next().value.decode("UTF-8", "replace")
+            comment = next(sexpr).value.decode("UTF-8", "replace")
             shape = next(sexpr)
             shape_iter = iter(shape)
-            cls = MAPAREA_SHAPE_TO_CLASS[shape_iter.next().value]
+            cls = MAPAREA_SHAPE_TO_CLASS[next(shape_iter).value]
             args = [int(item) for item in shape_iter]
             kwargs = dict(uri=uri, target=target, comment=comment, owner=owner)
             for item in sexpr:
@@ -420,6 +435,16 @@ class MapArea(Annotation):
     def _get_rect(self):
         raise NotImplementedError
 
+    def get_hit_rect(self):
+        """
+        Return the rectangle that contains every point for which
+        contains_point() is true.
+        """
+        return self._get_rect()
+
+    def contains_point(self, x, y):
+        return rect_contains_point(self._get_rect(), x, y)
+
     def _get_orign(self):
         return self._get_rect()[:2]
 
@@ -627,6 +652,15 @@ class OvalMapArea(XywhMapArea):
     def _get_sexpr_extra(self):
         return ()
 
+    def contains_point(self, x, y):
+        if self._w == 0 or self._h == 0:
+            # A degenerate oval is just a line segment.
+            return rect_contains_point(self._get_rect(), x, y)
+        rx, ry = self._w / 2.0, self._h / 2.0
+        dx = (x - self._x - rx) / rx
+        dy = (y - self._y - ry) / ry
+        return dx * dx + dy * dy <= 1
+
 
 class PolygonMapArea(MapArea):
 
@@ -666,6 +700,19 @@ class PolygonMapArea(MapArea):
         self._coords = list(map(xform, self._coords))
         self._notify_change()
 
+    def contains_point(self, x, y):
+        # Even-odd rule: count edges crossed by a horizontal ray cast from the
+        # point to the right.
+        result = False
+        coords = self._coords
+        x1, y1 = coords[-1]
+        for x2, y2 in coords:
+            if (y1 > y) != (y2 > y):
+                if x < x1 + (y - y1) * (x2 - x1) / float(y2 - y1):
+                    result = not result
+            x1, y1 = x2, y2
+        return result
+
     @classmethod
     def from_maparea(cls, maparea, owner):
         self = super(PolygonMapArea, cls).from_maparea(maparea, owner)
@@ -725,6 +772,26 @@ class LineMapArea(MapArea):
         self._x0, self._y0 = xform((self._x0, self._y0))
         self._x1, self._y1 = xform((self._x1, self._y1))
 
+    def contains_point(self, x, y):
+        x0, y0, x1, y1 = self._x0, self._y0, self._x1, self._y1
+        dx, dy = x1 - x0, y1 - y0
+        length2 = dx * dx + dy * dy
+        if length2 == 0:
+            t = 0
+        else:
+            t = max(0, min(1, ((x - x0) * dx + (y - y0) * dy) / float(length2)))
+        distance = math.hypot(x - x0 - t * dx, y - y0 - t * dy)
+        return distance <= self._get_hit_margin()
+
+    def _get_hit_margin(self):
+        # Thin lines would be hard to hit otherwise:
+        return max(self._line_width, 2)
+
+    def get_hit_rect(self):
+        x, y, w, h = self._get_rect()
+        margin = self._get_hit_margin()
+        return (x - margin, y - margin, w + 2 * margin, h + 2 * margin)
+
     @apply
     def point_from():
         def get(self):
@@ -935,9 +1002,10 @@ MAPAREA_SHAPE_TO_CLASS = dict(
 ANNOTATION_TYPE_TO_CLASS = {djvu.const.ANNOTATION_MAPAREA: MapArea}
 
 
-class PageAnnotations(object):
+class PageAnnotations(BatchingModel, PageModel):
     def __init__(self, n, original_data):
         self._old_data = original_data
+        self._original_digest = None
         self._callbacks = weakref.WeakKeyDictionary()
         self.revert()
         self._n = n
@@ -983,40 +1051,112 @@ class PageAnnotations(object):
     def mapareas(self):
         return self._data.get(MapArea, ())
 
+    def _get_spatial_index(self):
+        if self._spatial_index is None:
+            self._spatial_index = GridIndex.from_items(
+                (node, node.get_hit_rect()) for node in self.mapareas
+            )
+        return self._spatial_index
+
+    def find_mapareas_at(self, x, y):
+        """
+        Return mapareas containing the point, topmost first.
+        """
+        return [
+            node
+            for node in self._get_spatial_index().find_at(x, y)
+            if node.contains_point(x, y)
+        ]
+
+    def find_nearest_maparea(self, x, y, max_distance=None):
+        return self._get_spatial_index().find_nearest(x, y, max_distance)
+
     def revert(self):
         self._data = self._classify_data(self._old_data)
+        self._spatial_index = None
         self._dirty = False
 
+    def _get_sexprs(self, data):
+        return [node.sexpr for nodes in data.values() for node in nodes]
+
     def export(self, djvused):
-        if not self._dirty:
+        if not self.is_modified():
             return
         self.export_select(djvused)
-        djvused.set_annotations(
-            node.sexpr for nodes in self._data.values() for node in nodes
-        )
+        djvused.set_annotations(self._get_sexprs(self._data))
 
     def export_select(self, djvused):
         djvused.select(self._n + 1)
 
+    def is_dirty(self):
+        return self._dirty
+
+    def mark_saved(self):
+        if not self._dirty:
+            return
+        self._old_data = self._get_sexprs(self._data)
+        self._original_digest = None
+        self._dirty = False
+
+    def is_modified(self):
+        """
+        Return whether the annotations differ from the original ones.
+
+        Unlike is_dirty(), this is false if the changes have been reverted.
+        """
+        if not self._dirty:
+            return False
+        if self._original_digest is None:
+            # Parse the original data anew, so that both sides are serialised
+            # the same way:
+            original_data = self._classify_data(self._old_data)
+            self._original_digest = get_sexpr_digest(self._get_sexprs(original_data))
+        return get_sexpr_digest(self._get_sexprs(self._data)) != self._original_digest
+
+    def _begin_batch(self):
+        self._batch_events = []
+
+    def _commit_batch(self):
+        events = self._batch_events
+        del self._batch_events
+        if len(events) == 1:
+            [[method, args]] = events
+            self._send(method, *args)
+        elif events:
+            self._send("notify_mapareas_change")
+
+    def _send(self, method, *args):
+        if self._batch_depth:
+            event = method, args
+            if not self._batch_events or self._batch_events[-1] != event:
+                self._batch_events += [event]
+            return
+        for callback in self._callbacks:
+            getattr(callback, method)(*args)
+
     def notify_node_add(self, node):
         self._dirty = True
-        for callback in self._callbacks:
-            callback.notify_node_add(node)
+        if self._spatial_index is not None:
+            self._spatial_index.insert(node, node.get_hit_rect())
+        self._send("notify_node_add", node)
 
     def notify_node_change(self, node):
         self._dirty = True
-        for callback in self._callbacks:
-            callback.notify_node_change(node)
+        if self._spatial_index is not None:
+            self._spatial_index.update(node, node.get_hit_rect())
+        self._send("notify_node_change", node)
 
     def notify_node_replace(self, node, other_node):
         self._dirty = True
-        for callback in self._callbacks:
-            callback.notify_node_replace(node, other_node)
+        if self._spatial_index is not None:
+            self._spatial_index.replace(node, other_node, other_node.get_hit_rect())
+        self._send("notify_node_replace", node, other_node)
 
     def notify_node_delete(self, node):
         self._dirty = True
-        for callback in self._callbacks:
-            callback.notify_node_delete(node)
+        if self._spatial_index is not None:
+            self._spatial_index.remove(node)
+        self._send("notify_node_delete", node)
 
     def notify_node_select(self, node):
         for callback in self._callbacks:
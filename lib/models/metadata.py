@@ -22,7 +22,7 @@ See ``djvuchanges.txt``:
 - 5. Document Annotations and Metadata.
 """
 
-from djvusmooth.models import MultiPageModel, SHARED_ANNOTATIONS_PAGENO
+from djvusmooth.models import MultiPageModel, PageModel, SHARED_ANNOTATIONS_PAGENO
 
 
 class Metadata(MultiPageModel):
@@ -33,7 +33,7 @@ class Metadata(MultiPageModel):
             return PageMetadata
 
 
-class PageMetadata(dict):
+class PageMetadata(PageModel, dict):
     def __init__(self, n, original_data):
         self._old_data = None
         self._dirty = False
@@ -44,6 +44,11 @@ class PageMetadata(dict):
         self._dirty = True
         dict.__setitem__(self, key, value)
 
+    def replace_all(self, data):
+        self.clear()
+        self.update(data)
+        self._dirty = True
+
     def clone(self):
         from copy import copy
 
@@ -58,7 +63,7 @@ class PageMetadata(dict):
         djvused.select(self._n + 1)
 
     def export(self, djvused):
-        if not self._dirty:
+        if not self.is_modified():
             return
         self.export_select(djvused)
         djvused.set_metadata(self)
@@ -74,6 +79,18 @@ class PageMetadata(dict):
             except KeyError:
                 del self[key]
 
+    def mark_saved(self):
+        self._old_data = dict(self)
+        self._dirty = False
+
+    def is_modified(self):
+        """
+        Return whether the metadata differ from the original ones.
+
+        Unlike is_dirty(), this is false if the changes have been reverted.
+        """
+        return self._dirty and self != self._old_data
+
     def is_dirty(self, key=None):
         if key is None:
             return self._dirty
@@ -21,6 +21,7 @@ See Lizardtech DjVu Reference (DjVu 3):
 - 8.3.3 Document Outline Chunk.
 """
 
+import collections
 import weakref
 import itertools
 from apply import apply
@@ -29,6 +30,7 @@ import djvu.sexpr
 import djvu.const
 
 from djvusmooth.varietes import not_overridden, wref, fix_uri, indents_to_tree
+from djvusmooth.models import BatchingModel, get_sexpr_digest
 
 
 class Node(object):
@@ -36,6 +38,7 @@ class Node(object):
         self._owner = owner
         self._type = None
         self._link_left = self._link_right = self._link_parent = wref(None)
+        self._sexpr = None
 
     def _set_children(self, children):
         self._children = list(children)
@@ -73,7 +76,18 @@ class Node(object):
 
     @property
     def sexpr(self):
-        return self._construct_sexpr()
+        if self._sexpr is None:
+            self._sexpr = self._construct_sexpr()
+        return self._sexpr
+
+    def _invalidate(self):
+        """
+        Forget the cached serialisation of the node and of all its ancestors.
+        """
+        node = self
+        while node is not None:
+            node._sexpr = None
+            node = node._link_parent()
 
     def _construct_sexpr(self):
         raise NotImplementedError
@@ -142,14 +156,12 @@ class RootNode(Node):
     def __init__(self, sexpr, owner):
         Node.__init__(self, sexpr, owner)
         sexpr = iter(sexpr)
-        self._type = sexpr.next().value
+        self._type = next(sexpr).value
         self._set_children(InnerNode(subexpr, owner) for subexpr in sexpr)
 
     def _construct_sexpr(self):
         return djvu.sexpr.Expression(
-            itertools.chain(
-                (self.type,), (child._construct_sexpr() for child in self._children)
-            )
+            itertools.chain((self.type,), (child.sexpr for child in self._children))
         )
 
     def export_as_plaintext(self, stream):
@@ -161,15 +173,15 @@ class InnerNode(Node):
     def __init__(self, sexpr, owner):
         Node.__init__(self, sexpr, owner)
         sexpr = iter(sexpr)
-        self._text = sexpr.next().value.decode("UTF-8", "replace")
-        self._uri = fix_uri(sexpr.next().value)
+        self._text = next(sexpr).value.decode("UTF-8", "replace")
+        self._uri = fix_uri(next(sexpr).value)
         self._set_children(InnerNode(subexpr, owner) for subexpr in sexpr)
 
     def _construct_sexpr(self):
         return djvu.sexpr.Expression(
             itertools.chain(
                 (self.text, self.uri),
-                (child._construct_sexpr() for child in self._children),
+                (child.sexpr for child in self._children),
             )
         )
 
@@ -235,10 +247,11 @@ class OutlineCallback(object):
         pass
 
 
-class Outline(object):
+class Outline(BatchingModel):
     def __init__(self):
         self._callbacks = weakref.WeakKeyDictionary()
         self._original_sexpr = self.acquire_data()
+        self._original_digest = None
         self.revert()
 
     def register_callback(self, callback):
@@ -276,18 +289,47 @@ class Outline(object):
     def acquire_data(self):
         return djvu.const.EMPTY_OUTLINE
 
+    def _begin_batch(self):
+        self._batch_nodes = collections.OrderedDict()
+        self._batch_tree_changed = False
+
+    def _commit_batch(self):
+        if self._batch_tree_changed or len(self._batch_nodes) > 1:
+            self._send_tree_change()
+        else:
+            for node in self._batch_nodes:
+                self._send_node_change(node)
+        del self._batch_nodes
+
     def notify_tree_change(self):
         self._dirty = True
+        if self._batch_depth:
+            self._batch_tree_changed = True
+            return
+        self._send_tree_change()
+
+    def _send_tree_change(self):
         for callback in self._callbacks:
             callback.notify_tree_change(self._root)
 
     def notify_node_change(self, node):
         self._dirty = True
+        node._invalidate()
+        if self._batch_depth:
+            self._batch_nodes[node] = None
+            return
+        self._send_node_change(node)
+
+    def _send_node_change(self, node):
         for callback in self._callbacks:
             callback.notify_node_change(node)
 
     def notify_node_children_change(self, node):
         self._dirty = True
+        node._invalidate()
+        if self._batch_depth:
+            self._batch_tree_changed = True
+            return
         for callback in self._callbacks:
             callback.notify_node_children_change(node)
 
@@ -295,7 +337,31 @@ class Outline(object):
         for callback in self._callbacks:
             callback.notify_node_select(node)
 
+    def mark_saved(self):
+        if not self._dirty:
+            return
+        self._original_sexpr = self.raw_value
+        self._original_digest = None
+        self._dirty = False
+
+    def is_modified(self):
+        """
+        Return whether the outline differs from the original one.
+
+        Unlike the dirty flag, this is false if the changes have been reverted.
+        """
+        if not self._dirty:
+            return False
+        if self._original_digest is None:
+            original_root = RootNode(
+                self._original_sexpr or djvu.const.EMPTY_OUTLINE, self
+            )
+            self._original_digest = get_sexpr_digest([original_root.sexpr])
+        return get_sexpr_digest([self.raw_value]) != self._original_digest
+
     def export(self, djvused):
+        if not self.is_modified():
+            return
         if self.root:
             value = self.raw_value
         else:
@@ -0,0 +1,308 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2019 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+"""
+Spatial index of rectangles on a page.
+"""
+
+import itertools
+import math
+
+
+def rect_contains_point(rect, x, y):
+    rx, ry, rw, rh = rect
+    return rx <= x <= rx + rw and ry <= y <= ry + rh
+
+
+def rect_intersects(rect, other):
+    x, y, w, h = rect
+    ox, oy, ow, oh = other
+    return x <= ox + ow and ox <= x + w and y <= oy + oh and oy <= y + h
+
+
+def rect_contains_rect(rect, other):
+    x, y, w, h = rect
+    ox, oy, ow, oh = other
+    return x <= ox and y <= oy and ox + ow <= x + w and oy + oh <= y + h
+
+
+def rect_distance(rect, x, y):
+    """
+    Return the distance between the point and the rectangle.
+    """
+    rx, ry, rw, rh = rect
+    dx = max(rx - x, 0, x - rx - rw)
+    dy = max(ry - y, 0, y - ry - rh)
+    return math.hypot(dx, dy)
+
+
+class GridIndex(object):
+    """
+    Uniform grid of `cell_size`×`cell_size` cells, each one holding items
+    whose bounding rectangles overlap it.
+
+    Items spanning more than `max_cells` cells are kept aside in a set that
+    is scanned on every query; there are only a few of them (columns,
+    regions), and registering them in every cell would make updates slow.
+
+    Every item has a sequence number; queries return the items in the
+    reverse order, so that the item added last (the one drawn on top) comes
+    first.
+    """
+
+    def __init__(self, cell_size, max_cells=64):
+        self._cell_size = max(int(cell_size), 1)
+        self._max_cells = max_cells
+        self._cells = {}
+        self._large = set()
+        self._rects = {}
+        self._seqs = {}
+        self._next_seq = 0
+
+    @classmethod
+    def from_items(cls, items, min_cell_size=8):
+        """
+        Create an index from an iterable of (item, rect) pairs.
+
+        The cell size is derived from the median size of the rectangles.
+        """
+        items = list(items)
+        sizes = sorted(max(rect[2], rect[3]) for item, rect in items)
+        if sizes:
+            cell_size = 2 * sizes[len(sizes) // 2]
+        else:
+            cell_size = 0
+        self = cls(max(cell_size, min_cell_size))
+        for item, rect in items:
+            self.insert(item, rect)
+        return self
+
+    def __len__(self):
+        return len(self._rects)
+
+    def __contains__(self, item):
+        return item in self._rects
+
+    def _get_cell_range(self, rect):
+        x, y, w, h = rect
+        size = self._cell_size
+        return (
+            int(x // size),
+            int(y // size),
+            int((x + max(w, 0)) // size),
+            int((y + max(h, 0)) // size),
+        )
+
+    def _iter_cells(self, rect):
+        i0, j0, i1, j1 = self._get_cell_range(rect)
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                yield i, j
+
+    def _is_large(self, rect):
+        i0, j0, i1, j1 = self._get_cell_range(rect)
+        return (i1 - i0 + 1) * (j1 - j0 + 1) > self._max_cells
+
+    def _link(self, item, rect):
+        if self._is_large(rect):
+            self._large.add(item)
+            return
+        cells = self._cells
+        for key in self._iter_cells(rect):
+            try:
+                cells[key].add(item)
+            except KeyError:
+                cells[key] = {item}
+
+    def _unlink(self, item, rect):
+        if item in self._large:
+            self._large.discard(item)
+            return
+        cells = self._cells
+        for key in self._iter_cells(rect):
+            cell = cells.get(key)
+            if cell is None:
+                continue
+            cell.discard(item)
+            if not cell:
+                del cells[key]
+
+    def insert(self, item, rect, seq=None):
+        """
+        Add the item to the index. Unless `seq` is given, the item goes on top
+        of the other ones.
+        """
+        if item in self._rects:
+            self.remove(item)
+        rect = tuple(rect)
+        if seq is None:
+            seq = self._next_seq
+        self._next_seq = max(self._next_seq, seq + 1)
+        self._rects[item] = rect
+        self._seqs[item] = seq
+        self._link(item, rect)
+
+    def remove(self, item):
+        try:
+            rect = self._rects.pop(item)
+        except KeyError:
+            return
+        del self._seqs[item]
+        self._unlink(item, rect)
+
+    def update(self, item, rect):
+        """
+        Move the item, keeping its position in the stacking order.
+        """
+        rect = tuple(rect)
+        try:
+            old_rect = self._rects[item]
+        except KeyError:
+            self.insert(item, rect)
+            return
+        if old_rect == rect:
+            return
+        self._unlink(item, old_rect)
+        self._rects[item] = rect
+        self._link(item, rect)
+
+    def replace(self, item, other_item, rect):
+        """
+        Replace the item with another one, at the same position in the
+        stacking order.
+        """
+        seq = self._seqs.get(item)
+        self.remove(item)
+        self.insert(other_item, rect, seq=seq)
+
+    def get_rect(self, item):
+        return self._rects[item]
+
+    def _sorted(self, items):
+        seqs = self._seqs
+        return sorted(items, key=seqs.__getitem__, reverse=True)
+
+    def find_at(self, x, y):
+        """
+        Return items whose rectangles contain the point, topmost first.
+        """
+        size = self._cell_size
+        candidates = set(self._cells.get((int(x // size), int(y // size)), ()))
+        candidates.update(self._large)
+        rects = self._rects
+        result = [item for item in candidates if rect_contains_point(rects[item], x, y)]
+        return self._sorted(result)
+
+    def find_in_rect(self, rect, contained=False):
+        """
+        Return items whose rectangles intersect the given one (or, if
+        `contained` is true, lie wholly inside it), topmost first.
+        """
+        rect = tuple(rect)
+        candidates = set(self._large)
+        i0, j0, i1, j1 = self._get_cell_range(rect)
+        cells = self._cells
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(cells):
+            # The query is larger than the occupied area; don't visit empty
+            # cells.
+            for (i, j), cell in cells.items():
+                if i0 <= i <= i1 and j0 <= j <= j1:
+                    candidates.update(cell)
+        else:
+            for key in self._iter_cells(rect):
+                candidates.update(cells.get(key, ()))
+        test = rect_contains_rect if contained else rect_intersects
+        rects = self._rects
+        result = [item for item in candidates if test(rect, rects[item])]
+        return self._sorted(result)
+
+    def find_nearest(self, x, y, max_distance=None, predicate=None):
+        """
+        Return the item whose rectangle is the nearest to the point, or None.
+        If `predicate` is given, only items for which it returns true are
+        considered.
+
+        Cells are visited in rings of growing radius around the point, until
+        no unvisited cell can hold anything nearer than the best candidate.
+        """
+        rects = self._rects
+        best = None
+        best_distance = max_distance
+
+        def consider(items):
+            nonlocal best, best_distance
+            for item in items:
+                distance = rect_distance(rects[item], x, y)
+                if best_distance is not None and distance > best_distance:
+                    continue
+                if predicate is not None and not predicate(item):
+                    continue
+                if (
+                    best is None
+                    or distance < best_distance
+                    or (
+                        distance == best_distance
+                        and self._seqs[item] > self._seqs[best]
+                    )
+                ):
+                    best = item
+                    best_distance = distance
+
+        consider(self._large)
+        cells = self._cells
+        if not cells:
+            return best
+        size = self._cell_size
+        ci, cj = int(x // size), int(y // size)
+        for radius in itertools.count():
+            if best_distance is not None and best_distance < (radius - 1) * size:
+                break
+            if 8 * radius > len(cells):
+                # The rings are mostly empty from now on; it's cheaper to
+                # visit the remaining occupied cells directly.
+                for (i, j), cell in cells.items():
+                    if max(abs(i - ci), abs(j - cj)) >= radius:
+                        consider(cell)
+                break
+            if radius == 0:
+                ring = [(ci, cj)]
+            else:
+                ring = []
+                for k in range(-radius, radius + 1):
+                    ring += [
+                        (ci + k, cj - radius),
+                        (ci + k, cj + radius),
+                    ]
+                for k in range(-radius + 1, radius):
+                    ring += [
+                        (ci - radius, cj + k),
+                        (ci + radius, cj + k),
+                    ]
+            for key in ring:
+                cell = cells.get(key)
+                if cell is not None:
+                    consider(cell)
+        return best
+
+
+__all__ = [
+    "GridIndex",
+    "rect_contains_point",
+    "rect_intersects",
+    "rect_contains_rect",
+    "rect_distance",
+]
+
+# vim:ts=4 sts=4 sw=4 et
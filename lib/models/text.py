@@ -21,146 +21,503 @@ See Lizardtech DjVu Reference (DjVu 3):
 - 8.3.5 Text Chunk.
 """
 
+import array
+import collections
 import copy
 import weakref
-import itertools
 from apply import apply
 
+import djvu.const
 import djvu.decode
 import djvu.sexpr
 
-from djvusmooth.varietes import not_overridden, wref
-from djvusmooth.models import MultiPageModel
+from djvusmooth.varietes import not_overridden
+from djvusmooth.models import MultiPageModel, BatchingModel, PageModel
+from djvusmooth.models import get_sexpr_digest
+from djvusmooth.models.spatial import GridIndex
+
+# Zone types, ordered from the smallest to the largest one:
+_ZONE_TYPES = tuple(sorted(djvu.const.TEXT_ZONE_SEPARATORS))
+_ZONE_TYPE_INDICES = dict((type, i) for i, type in enumerate(_ZONE_TYPES))
+
+_NIL = -1
+
+
+def _is_leaf_sexpr(sexpr):
+    return len(sexpr) == 6 and isinstance(sexpr[5], djvu.sexpr.StringExpression)
+
+
+class _ZoneStore(object):
+    """
+    Zones of a single page, kept in flat arrays rather than as separate
+    Python objects.
+
+    Zone number i is described by the i-th item of each of the arrays (or
+    items 4i to 4i+3 of the `rects` array). Inner zones have no text, i.e.
+    their text offset is -1. Texts of leaf zones are stored in a single UTF-8
+    buffer.
+
+    Children of an inner zone are created from the original s-expression
+    only when they are first accessed.
+    """
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.types = array.array("b")
+        self.rects = array.array("l")
+        self.parents = array.array("l")
+        self.first_children = array.array("l")
+        self.last_children = array.array("l")
+        self.next_siblings = array.array("l")
+        self.prev_siblings = array.array("l")
+        self.text_offsets = array.array("l")
+        self.text_lengths = array.array("l")
+        self.text_pool = bytearray()
+        self._garbage = 0
+        # S-expressions of inner zones whose children haven't been created yet:
+        self._pending = {}
+        # Serialised inner zones:
+        self._sexprs = {}
+        # Traversal orders, forgotten whenever the tree structure changes:
+        self._orders = {}
 
-
-class Node(object):
-    def __new__(cls, sexpr, owner):
-        if len(sexpr) == 6 and isinstance(sexpr[5], djvu.sexpr.StringExpression):
-            cls = LeafNode
+    def __len__(self):
+        return len(self.types)
+
+    def new_zone(self, type, rect, text=None):
+        id = len(self.types)
+        self.types.append(_ZONE_TYPE_INDICES[type])
+        self.rects.extend(int(value) for value in rect)
+        for links in (
+            self.parents,
+            self.first_children,
+            self.last_children,
+            self.next_siblings,
+            self.prev_siblings,
+        ):
+            links.append(_NIL)
+        if text is None:
+            self.text_offsets.append(_NIL)
+            self.text_lengths.append(0)
         else:
-            cls = InnerNode
-        return object.__new__(cls)
+            self.text_offsets.append(0)
+            self.text_lengths.append(0)
+            self.set_text(id, text)
+        return id
 
-    def __init__(self, sexpr, owner):
-        self._owner = owner
-        self._type = djvu.const.get_text_zone_type(sexpr[0].value)
+    def _new_zone_from_sexpr(self, sexpr):
+        type = djvu.const.get_text_zone_type(sexpr[0].value)
         x0, y0, x1, y1 = (sexpr[i].value for i in range(1, 5))
-        self._x = x0
-        self._y = y0
-        self._w = x1 - x0
-        self._h = y1 - y0
-        self._link_left = self._link_right = self._link_parent = wref(None)
+        rect = (x0, y0, x1 - x0, y1 - y0)
+        if _is_leaf_sexpr(sexpr):
+            text = sexpr[5].bytes.decode("UTF-8", "replace")
+            return self.new_zone(type, rect, text)
+        id = self.new_zone(type, rect)
+        self._pending[id] = sexpr
+        return id
+
+    def load(self, sexpr):
+        """
+        Create the top zone from the s-expression. Return its number.
+
+        Children of the zone are created only when they are needed.
+        """
+        return self._new_zone_from_sexpr(sexpr)
+
+    def _expand(self, id):
+        try:
+            sexpr = self._pending.pop(id)
+        except KeyError:
+            return
+        # This doesn't change the tree, as seen from the outside, so the
+        # cached traversal orders are still valid.
+        for child_sexpr in sexpr[5:]:
+            self._link_child(id, self._new_zone_from_sexpr(child_sexpr))
+
+    def get_type(self, id):
+        return _ZONE_TYPES[self.types[id]]
+
+    def get_rect(self, id):
+        i = 4 * id
+        return tuple(self.rects[i : i + 4])
+
+    def set_rect(self, id, rect):
+        i = 4 * id
+        self.rects[i : i + 4] = array.array("l", (int(value) for value in rect))
+
+    def is_leaf(self, id):
+        return self.text_offsets[id] != _NIL
+
+    def get_text(self, id):
+        offset = self.text_offsets[id]
+        if offset == _NIL:
+            return None
+        data = self.text_pool[offset : offset + self.text_lengths[id]]
+        return data.decode("UTF-8")
+
+    def set_text(self, id, text):
+        data = text.encode("UTF-8")
+        if self.text_offsets[id] != _NIL:
+            self._garbage += self.text_lengths[id]
+        else:
+            # An inner zone becomes a leaf.
+            self._orders.clear()
+        self.text_offsets[id] = len(self.text_pool)
+        self.text_lengths[id] = len(data)
+        self.text_pool += data
+        if self._garbage > 1 << 16 and 2 * self._garbage > len(self.text_pool):
+            self._compact_text_pool()
+
+    def _compact_text_pool(self):
+        pool = bytearray()
+        for id, offset in enumerate(self.text_offsets):
+            if offset == _NIL:
+                continue
+            self.text_offsets[id] = len(pool)
+            pool += self.text_pool[offset : offset + self.text_lengths[id]]
+        self.text_pool = pool
+        self._garbage = 0
+
+    def make_inner(self, id):
+        if self.text_offsets[id] != _NIL:
+            self._garbage += self.text_lengths[id]
+            self._orders.clear()
+        self.text_offsets[id] = _NIL
+        self.text_lengths[id] = 0
+
+    def get_first_child(self, id):
+        self._expand(id)
+        return self.first_children[id]
+
+    def get_children(self, id):
+        self._expand(id)
+        result = []
+        child = self.first_children[id]
+        while child != _NIL:
+            result += [child]
+            child = self.next_siblings[child]
+        return result
+
+    def append_child(self, id, child):
+        if id in self._pending:
+            self._expand(id)
+        self._link_child(id, child)
+        self._orders.clear()
+
+    def _link_child(self, id, child):
+        last = self.last_children[id]
+        self.parents[child] = id
+        self.prev_siblings[child] = last
+        self.next_siblings[child] = _NIL
+        if last == _NIL:
+            self.first_children[id] = child
+        else:
+            self.next_siblings[last] = child
+        self.last_children[id] = child
+
+    def unlink(self, child):
+        id = self.parents[child]
+        prev = self.prev_siblings[child]
+        next = self.next_siblings[child]
+        if prev == _NIL:
+            self.first_children[id] = next
+        else:
+            self.next_siblings[prev] = next
+        if next == _NIL:
+            self.last_children[id] = prev
+        else:
+            self.prev_siblings[next] = prev
+        self._detach(child)
+
+    def _detach(self, child):
+        self._orders.clear()
+        self.parents[child] = _NIL
+        self.prev_siblings[child] = _NIL
+        self.next_siblings[child] = _NIL
+
+    def set_children(self, id, children):
+        for child in self.get_children(id):
+            self._detach(child)
+        self.first_children[id] = self.last_children[id] = _NIL
+        for child in children:
+            self.append_child(id, child)
+
+    def iter_preorder(self, id):
+        stack = [id]
+        while stack:
+            id = stack.pop()
+            yield id
+            stack += reversed(self.get_children(id))
+
+    def iter_postorder(self, id, expand=True):
+        stack = [(id, False)]
+        while stack:
+            id, visited = stack.pop()
+            if visited or self.is_leaf(id):
+                yield id
+                continue
+            if not expand and id in self._pending:
+                yield id
+                continue
+            stack += [(id, True)]
+            stack += ((child, False) for child in reversed(self.get_children(id)))
+
+    def iter_leafs(self, id):
+        for id in self.iter_preorder(id):
+            if self.is_leaf(id):
+                yield id
+
+    def _get_order(self, kind, id, iterator):
+        key = kind, id
+        try:
+            return self._orders[key]
+        except KeyError:
+            pass
+        order = array.array("l", iterator)
+        self._orders[key] = order
+        return order
+
+    def get_preorder(self, id):
+        """
+        Return numbers of the zone and all its descendants, in preorder.
+
+        The result is cached until the tree structure changes; it must not be
+        modified.
+        """
+        return self._get_order("preorder", id, self.iter_preorder(id))
+
+    def get_postorder(self, id):
+        return self._get_order("postorder", id, self.iter_postorder(id))
+
+    def get_leafs(self, id):
+        is_leaf = self.is_leaf
+        leafs = (id for id in self.get_preorder(id) if is_leaf(id))
+        return self._get_order("leafs", id, leafs)
+
+    def _get_leaf_sexpr(self, id):
+        x, y, w, h = self.get_rect(id)
+        return djvu.sexpr.Expression(
+            (self.get_type(id), x, y, x + w, y + h, self.get_text(id))
+        )
+
+    def get_sexpr(self, id):
+        """
+        Serialise the zone.
+
+        Serialised inner zones are cached, until invalidate() is called for
+        them or their descendants.
+        """
+        if self.is_leaf(id):
+            return self._get_leaf_sexpr(id)
+        cache = self._sexprs
+        top = id
+        stack = [(top, False)]
+        while stack:
+            id, visited = stack.pop()
+            if id in cache or self.is_leaf(id):
+                continue
+            if id in self._pending:
+                # Don't create zones just to serialise them.
+                tail = tuple(self._pending[id][5:])
+            elif visited:
+                tail = tuple(
+                    cache[child] if child in cache else self._get_leaf_sexpr(child)
+                    for child in self.get_children(id)
+                )
+            else:
+                stack += [(id, True)]
+                stack += ((child, False) for child in self.get_children(id))
+                continue
+            if not tail:
+                # FIXME: this needs a better solution
+                tail = (djvu.sexpr.Expression(""),)
+            x, y, w, h = self.get_rect(id)
+            head = (self.get_type(id), x, y, x + w, y + h)
+            cache[id] = djvu.sexpr.Expression(head + tail)
+        return cache[top]
+
+    def invalidate(self, id):
+        """
+        Forget the cached serialisation of the zone and of all its ancestors.
+        """
+        while id != _NIL:
+            self._sexprs.pop(id, None)
+            id = self.parents[id]
+
+    def invalidate_all(self):
+        self._sexprs.clear()
+
+    def strip(self, id, zone_type):
+        """
+        Flatten all the zones of the type `zone_type` or smaller into text of
+        their parent.
+
+        Return either the top zone number, or the flattened text and the
+        separator that should follow it.
+        """
+        results = {}
+        top = id
+        for id in self.iter_postorder(top):
+            type = self.get_type(id)
+            separator = djvu.const.TEXT_ZONE_SEPARATORS[type]
+            if self.is_leaf(id):
+                if type <= zone_type:
+                    results[id] = self.get_text(id), separator
+                else:
+                    results[id] = id
+                continue
+            stripped_children = [results.pop(child) for child in self.get_children(id)]
+            node_children = [
+                child for child in stripped_children if not isinstance(child, tuple)
+            ]
+            texts = [
+                child[0] for child in stripped_children if isinstance(child, tuple)
+            ]
+            child_separator = ""
+            if stripped_children and isinstance(stripped_children[-1], tuple):
+                child_separator = stripped_children[-1][1]
+            if type <= zone_type:
+                results[id] = child_separator.join(texts), separator
+            elif node_children:
+                self.set_children(id, node_children)
+                results[id] = id
+            else:
+                self.set_children(id, ())
+                self.set_text(id, child_separator.join(texts))
+                results[id] = id
+        return results[top]
+
+
+class Node(object):
+    """
+    A view of a single zone.
+    """
+
+    __slots__ = ("_store", "_id")
+
+    def __init__(self, store, id):
+        self._store = store
+        self._id = id
+
+    def __eq__(self, other):
+        if not isinstance(other, Node):
+            return NotImplemented
+        return self._store is other._store and self._id == other._id
+
+    def __ne__(self, other):
+        if not isinstance(other, Node):
+            return NotImplemented
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self._store), self._id))
+
+    def __repr__(self):
+        return "<{mod}.{cls} #{id}: {type}>".format(
+            mod=self.__module__, cls=type(self).__name__, id=self._id, type=self.type
+        )
 
     @property
-    def sexpr(self):
-        return self._construct_sexpr()
+    def _owner(self):
+        return self._store.owner
 
-    def _construct_sexpr(self):
-        raise NotImplementedError
+    @property
+    def sexpr(self):
+        return self._store.get_sexpr(self._id)
 
     @apply
     def separator():
         def get(self):
-            return djvu.const.TEXT_ZONE_SEPARATORS[self._type]
+            return djvu.const.TEXT_ZONE_SEPARATORS[self.type]
 
         return property(get)
 
-    @apply
-    def x():
+    def _get_rect_item(i):
         def get(self):
-            return self._x
+            return self._store.get_rect(self._id)[i]
 
         def set(self, value):
-            self._x = value
+            rect = list(self._store.get_rect(self._id))
+            rect[i] = value
+            self._store.set_rect(self._id, rect)
             self._notify_change()
 
         return property(get, set)
 
-    @apply
-    def y():
-        def get(self):
-            return self._y
-
-        def set(self, value):
-            self._y = value
-            self._notify_change()
+    x = _get_rect_item(0)
+    y = _get_rect_item(1)
+    w = _get_rect_item(2)
+    h = _get_rect_item(3)
 
-        return property(get, set)
+    del _get_rect_item
 
     @apply
-    def w():
+    def rect():
         def get(self):
-            return self._w
+            return self._store.get_rect(self._id)
 
         def set(self, value):
-            self._w = value
+            self._store.set_rect(self._id, value)
             self._notify_change()
 
         return property(get, set)
 
     @apply
-    def h():
+    def type():
         def get(self):
-            return self._h
-
-        def set(self, value):
-            self._h = value
-            self._notify_change()
+            return self._store.get_type(self._id)
 
-        return property(get, set)
+        return property(get)
 
     @apply
-    def rect():
+    def text():
         def get(self):
-            return self._x, self._y, self._w, self._h
+            if not self.is_leaf():
+                raise AttributeError("{0!r} has no text".format(self))
+            return self._store.get_text(self._id)
 
         def set(self, value):
-            self._x, self._y, self._w, self._h = value
+            if not self.is_leaf():
+                raise AttributeError("{0!r} has no text".format(self))
+            self._store.set_text(self._id, value)
             self._notify_change()
 
         return property(get, set)
 
-    @apply
-    def type():
-        def get(self):
-            return self._type
-
-        return property(get)
+    def _get_link(self, links):
+        link = links[self._id]
+        if link == _NIL:
+            raise StopIteration
+        return Node(self._store, link)
 
     @apply
     def left_sibling():
         def get(self):
-            link = self._link_left()
-            if link is None:
-                raise StopIteration
-            return link
+            return self._get_link(self._store.prev_siblings)
 
         return property(get)
 
     @apply
     def right_sibling():
         def get(self):
-            link = self._link_right()
-            if link is None:
-                raise StopIteration
-            return link
+            return self._get_link(self._store.next_siblings)
 
         return property(get)
 
     @apply
     def parent():
         def get(self):
-            link = self._link_parent()
-            if link is None:
-                raise StopIteration
-            return link
+            return self._get_link(self._store.parents)
 
         return property(get)
 
     @apply
     def left_child():
         def get(self):
-            raise StopIteration
+            link = self._store.get_first_child(self._id)
+            if link == _NIL:
+                raise StopIteration
+            return Node(self._store, link)
 
         return property(get)
 
@@ -172,16 +529,33 @@ class Node(object):
         parent.remove_child(self)
 
     def remove_child(self, child):
-        raise NotImplementedError
-
-    def strip(self, zone_type):
-        raise NotImplementedError
+        if self.is_leaf():
+            raise TypeError("{0!r} cannot have children".format(self))
+        if child.parent != self:
+            raise ValueError("{0!r} is not a child of {1!r}".format(child, self))
+        self._store.unlink(child._id)
+        self._notify_children_change()
 
     def is_leaf(self):
-        return False
+        return self._store.is_leaf(self._id)
 
     def is_inner(self):
-        return False
+        return not self._store.is_leaf(self._id)
+
+    def _get_children(self):
+        if self.is_leaf():
+            raise TypeError
+        return self._store.get_children(self._id)
+
+    def __getitem__(self, n):
+        return Node(self._store, self._get_children()[n])
+
+    def __len__(self):
+        return len(self._get_children())
+
+    def __iter__(self):
+        store = self._store
+        return (Node(store, id) for id in self._get_children())
 
     def notify_select(self):
         self._owner.notify_node_select(self)
@@ -196,139 +570,6 @@ class Node(object):
         return self._owner.notify_node_children_change(self)
 
 
-class LeafNode(Node):
-    def is_leaf(self):
-        return True
-
-    def __init__(self, sexpr, owner):
-        Node.__init__(self, sexpr, owner)
-        self._text = sexpr[5].value.decode("UTF-8", "replace")
-
-    def _construct_sexpr(self):
-        x, y, w, h = self.x, self.y, self.w, self.h
-        return djvu.sexpr.Expression((self.type, x, y, x + w, y + h, self.text))
-
-    @apply
-    def text():
-        def get(self):
-            return self._text
-
-        def set(self, value):
-            self._text = value
-            self._notify_change()
-
-        return property(get, set)
-
-    def remove_child(self, child):
-        raise TypeError("{0!r} cannot have children".format(self))
-
-    def strip(self, zone_type):
-        if self.type <= zone_type:
-            return self.text, self.separator
-        return self
-
-    def __getitem__(self, n):
-        raise TypeError
-
-    def __len__(self):
-        raise TypeError
-
-    def __iter__(self):
-        raise TypeError
-
-
-class InnerNode(Node):
-    def is_inner(self):
-        return True
-
-    def __init__(self, sexpr, owner):
-        Node.__init__(self, sexpr, owner)
-        self._set_children(Node(child, self._owner) for child in sexpr[5:])
-
-    def _set_children(self, children):
-        self._children = list(children)
-        prev = None
-        for child in self._children:
-            child._link_left = wref(prev)
-            child._link_parent = wref(self)
-            prev = child
-        prev = None
-        for child in reversed(self._children):
-            child._link_right = wref(prev)
-            prev = child
-
-    def _construct_sexpr(self):
-        x, y, w, h = self.x, self.y, self.w, self.h
-        if self._children:
-            child_sexprs = (child.sexpr for child in self)
-        else:
-            # FIXME: this needs a better solution
-            child_sexprs = (djvu.sexpr.Expression(""),)
-        return djvu.sexpr.Expression(
-            itertools.chain((self.type, x, y, x + w, y + h), child_sexprs)
-        )
-
-    @apply
-    def text():
-        return property()
-
-    @apply
-    def left_child():
-        def get(self):
-            return next(iter(self._children))
-
-        return property(get)
-
-    def remove_child(self, child):
-        child_idx = self._children.index(child)
-        if child_idx - 1 >= 0:
-            self._children[child_idx - 1]._link_right = child._link_right
-        if child_idx + 1 < len(self._children):
-            self._children[child_idx + 1]._link_left = child._link_left
-        child._link_left = child._link_right = child._link_parent = wref(None)
-        del self._children[child_idx]
-        self._notify_children_change()
-
-    def strip(self, zone_type):
-        stripped_children = [child.strip(zone_type) for child in self._children]
-        if self.type <= zone_type:
-            texts = [text for text, child_separator in stripped_children]
-            return child_separator.join(texts), self.separator
-        else:
-            node_children = [
-                child for child in stripped_children if isinstance(child, Node)
-            ]
-            if node_children:
-                self._set_children(node_children)
-                return self
-            else:
-                texts = [text for text, child_separator in stripped_children]
-                text = child_separator.join(texts)
-                return Node(
-                    djvu.sexpr.Expression(
-                        (
-                            self.type,
-                            self.x,
-                            self.y,
-                            self.x + self.w,
-                            self.y + self.h,
-                            text,
-                        )
-                    ),
-                    self._owner,
-                )
-        return self
-
-    def __getitem__(self, n):
-        return self._children[n]
-
-    def __len__(self):
-        return len(self._children)
-
-    def __iter__(self):
-        return iter(self._children)
-
-
 class Text(MultiPageModel):
     def get_page_model_class(self, n):
         return PageText
@@ -356,10 +597,11 @@ class PageTextCallback(object):
         pass
 
 
-class PageText(object):
+class PageText(BatchingModel, PageModel):
     def __init__(self, n, original_data):
         self._callbacks = weakref.WeakKeyDictionary()
         self._original_sexpr = original_data
+        self._original_digest = None
         self.revert()
         self._n = n
 
@@ -371,22 +613,25 @@ class PageText(object):
     @apply
     def root():
         def get(self):
-            return self._root
+            if self._root_id == _NIL:
+                return None
+            return Node(self._store, self._root_id)
 
         return property(get)
 
     @apply
     def raw_value():
         def get(self):
-            if self._root is None:
+            if self._root_id == _NIL:
                 return None
-            return self._root.sexpr
+            return self._store.get_sexpr(self._root_id)
 
         def set(self, sexpr):
+            self._store = _ZoneStore(self)
             if sexpr:
-                self._root = Node(sexpr, self)
+                self._root_id = self._store.load(sexpr)
             else:
-                self._root = None
+                self._root_id = _NIL
             self.notify_tree_change()
 
         return property(get, set)
@@ -395,19 +640,18 @@ class PageText(object):
         zone_type = djvu.const.get_text_zone_type(
             zone_type
         )  # ensure it's not a plain Symbol
-        if self._root is None:
+        if self._root_id == _NIL:
             return
-        stripped_root = self._root.strip(zone_type)
-        if not isinstance(stripped_root, Node):
-            stripped_root = None
-        self._root = stripped_root
+        stripped_root = self._store.strip(self._root_id, zone_type)
+        if isinstance(stripped_root, tuple):
+            self._root_id = _NIL
         self.notify_tree_change()
 
     def clone(self):
         return copy.copy(self)
 
     def export(self, djvused):
-        if not self._dirty:
+        if not self.is_modified():
             return
         djvused.select(self._n + 1)
         djvused.set_text(self.raw_value)
@@ -416,13 +660,66 @@ class PageText(object):
         self.raw_value = self._original_sexpr
         self._dirty = False
 
+    def is_dirty(self):
+        return self._dirty
+
+    def mark_saved(self):
+        if not self._dirty:
+            return
+        self._original_sexpr = self.raw_value
+        self._original_digest = None
+        self._dirty = False
+
+    def is_modified(self):
+        """
+        Return whether the text differs from the original one.
+
+        Unlike is_dirty(), this is false if the changes have been reverted.
+        """
+        if not self._dirty:
+            return False
+        if self._original_digest is None:
+            self._original_digest = get_sexpr_digest(
+                [self._original_sexpr] if self._original_sexpr else []
+            )
+        raw_value = self.raw_value
+        digest = get_sexpr_digest([raw_value] if raw_value else [])
+        return digest != self._original_digest
+
+    def _begin_batch(self):
+        self._batch_nodes = collections.OrderedDict()
+        self._batch_tree_changed = False
+
+    def _commit_batch(self):
+        # Many changes are cheaper to handle as a single big one.
+        if self._batch_tree_changed or len(self._batch_nodes) > 1:
+            self._send_tree_change()
+        else:
+            for node in self._batch_nodes:
+                self._send_node_change(node)
+        del self._batch_nodes
+
     def notify_node_change(self, node):
         self._dirty = True
+        self._store.invalidate(node._id)
+        if self._spatial_index is not None:
+            self._spatial_index.update(node._id, self._store.get_rect(node._id))
+        if self._batch_depth:
+            self._batch_nodes[node] = None
+            return
+        self._send_node_change(node)
+
+    def _send_node_change(self, node):
         for callback in self._callbacks:
             callback.notify_node_change(node)
 
     def notify_node_children_change(self, node):
         self._dirty = True
+        self._store.invalidate(node._id)
+        self._spatial_index = None
+        if self._batch_depth:
+            self._batch_tree_changed = True
+            return
         for callback in self._callbacks:
             callback.notify_node_children_change(node)
 
@@ -436,49 +733,84 @@ class PageText(object):
 
     def notify_tree_change(self):
         self._dirty = True
+        self._store.invalidate_all()
+        self._spatial_index = None
+        if self._batch_depth:
+            self._batch_tree_changed = True
+            return
+        self._send_tree_change()
+
+    def _send_tree_change(self):
         for callback in self._callbacks:
-            callback.notify_tree_change(self._root)
+            callback.notify_tree_change(self.root)
+
+    def _iter_nodes(self, ids):
+        store = self._store
+        for id in ids:
+            yield Node(store, id)
 
     def get_preorder_nodes(self):
-        if self.root is None:
+        if self._root_id == _NIL:
             return ()
-        return _get_preorder_nodes(self.root)
+        return self._iter_nodes(self._store.get_preorder(self._root_id))
 
     def get_postorder_nodes(self):
-        if self.root is None:
+        if self._root_id == _NIL:
             return ()
-        return _get_postorder_nodes(self.root)
+        return self._iter_nodes(self._store.get_postorder(self._root_id))
 
     def get_leafs(self):
-        if self.root is None:
+        if self._root_id == _NIL:
             return ()
-        return _get_leafs(self.root)
-
+        return self._iter_nodes(self._store.get_leafs(self._root_id))
 
-def _get_preorder_nodes(node):
-    yield node
-    if isinstance(node, LeafNode):
-        return
-    for child in node:
-        for item in _get_preorder_nodes(child):
-            yield item
-
-
-def _get_postorder_nodes(node):
-    if isinstance(node, InnerNode):
-        for child in node:
-            for item in _get_postorder_nodes(child):
-                yield item
-    yield node
+    def _get_spatial_index(self):
+        if self._spatial_index is None:
+            store = self._store
+            if self._root_id == _NIL:
+                ids = ()
+            else:
+                ids = store.get_preorder(self._root_id)
+            # Zones are numbered in preorder, so descendants come before their
+            # ancestors in query results.
+            self._spatial_index = GridIndex.from_items(
+                (id, store.get_rect(id)) for id in ids
+            )
+        return self._spatial_index
+
+    def find_nodes_at(self, x, y):
+        """
+        Return zones containing the point, innermost first.
+        """
+        return list(self._iter_nodes(self._get_spatial_index().find_at(x, y)))
+
+    def find_nodes_in_rect(self, rect, contained=False):
+        """
+        Return zones intersecting the rectangle (or, if `contained` is true,
+        lying wholly inside it), innermost first.
+        """
+        index = self._get_spatial_index()
+        return list(self._iter_nodes(index.find_in_rect(rect, contained)))
+
+    def find_nearest_node(self, x, y, zone_type=None, max_distance=None):
+        """
+        Return the zone (of the given type, if `zone_type` is not None)
+        nearest to the point, or None.
+        """
+        store = self._store
+        if zone_type is None:
+            predicate = None
+        else:
+            zone_type = djvu.const.get_text_zone_type(zone_type)
 
+            def predicate(id):
+                return store.get_type(id) == zone_type
 
-def _get_leafs(node):
-    if isinstance(node, LeafNode):
-        yield node
-    else:
-        for child in node:
-            for item in _get_leafs(child):
-                yield item
+        index = self._get_spatial_index()
+        id = index.find_nearest(x, y, max_distance, predicate)
+        if id is None:
+            return None
+        return Node(store, id)
 
 
 __all__ = ["Text", "PageText"]
@@ -0,0 +1,147 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2019 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+"""
+Background acquisition of page models' data.
+"""
+
+import itertools
+import queue
+import threading
+
+
+class Prefetcher(object):
+    """
+    Acquire data of pages around the current one in worker threads.
+
+    The current page goes first, then the neighbouring pages in the direction
+    of navigation, then the ones behind, and finally the more distant pages
+    (up to `idle_radius` pages away). Every new schedule() call cancels the
+    requests made by the previous one.
+    """
+
+    def __init__(self, models, n_pages, n_workers=2, ahead=3, behind=1, idle_radius=10):
+        self._models = models
+        self._n_pages = n_pages
+        self._ahead = ahead
+        self._behind = behind
+        self._idle_radius = idle_radius
+        self._queue = queue.PriorityQueue()
+        self._generation = 0
+        self._counter = itertools.count()
+        self._closed = False
+        self._paused = False
+        self._n_active = 0
+        self._condition = threading.Condition()
+        self._threads = []
+        for i in range(n_workers):
+            thread = threading.Thread(target=self._work, name="djvusmooth-prefetch")
+            thread.daemon = True
+            thread.start()
+            self._threads += [thread]
+
+    def _get_plan(self, page_no, direction):
+        """
+        Return page numbers in the order they should be acquired.
+        """
+        step = -1 if direction < 0 else 1
+        plan = [page_no]
+        plan += [page_no + step * i for i in range(1, self._ahead + 1)]
+        plan += [page_no - step * i for i in range(1, self._behind + 1)]
+        for i in range(1, self._idle_radius + 1):
+            plan += [page_no + step * i, page_no - step * i]
+        result = []
+        seen = set()
+        for n in plan:
+            if 0 <= n < self._n_pages and n not in seen:
+                seen.add(n)
+                result += [n]
+        return result
+
+    def schedule(self, page_no, direction=1):
+        """
+        Cancel pending requests, and start acquiring data of the page
+        `page_no` and its surroundings.
+        """
+        plan = self._get_plan(page_no, direction)
+        self._generation += 1
+        generation = self._generation
+        for model in self._models:
+            model.forget_prefetched(keep=plan)
+        for priority, n in enumerate(plan):
+            self._queue.put((priority, next(self._counter), generation, n))
+
+    def cancel(self):
+        self._generation += 1
+
+    def pause(self):
+        """
+        Stop acquiring data, and wait until the requests in progress finish.
+        """
+        with self._condition:
+            self._paused = True
+            while self._n_active > 0:
+                self._condition.wait()
+
+    def resume(self):
+        with self._condition:
+            self._paused = False
+            self._condition.notify_all()
+
+    def close(self):
+        self._closed = True
+        self.cancel()
+        with self._condition:
+            self._condition.notify_all()
+        for thread in self._threads:
+            # Wake up the worker:
+            self._queue.put((-1, next(self._counter), None, None))
+
+    def _work(self):
+        while True:
+            priority, _, generation, n = self._queue.get()
+            if self._closed:
+                return
+            if generation != self._generation:
+                # Stale request.
+                continue
+            with self._condition:
+                while self._paused and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                self._n_active += 1
+            try:
+                self._prefetch(generation, n)
+            finally:
+                with self._condition:
+                    self._n_active -= 1
+                    self._condition.notify_all()
+
+    def _prefetch(self, generation, n):
+        for model in self._models:
+            if generation != self._generation:
+                break
+            try:
+                model.prefetch(n)
+            except Exception:
+                # The page will be acquired again (and the error will be
+                # reported) when it's actually needed.
+                pass
+
+
+__all__ = ["Prefetcher"]
+
+# vim:ts=4 sts=4 sw=4 et
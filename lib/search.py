@@ -0,0 +1,483 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2019 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+"""
+Persistent full-text index of the hidden text.
+
+The index is an SQLite database in the user's cache directory, one per
+document. Words of every page are stored together with their page numbers and
+zone rectangles. The database remembers size and modification time of the
+document; if they don't match, the index is rebuilt from scratch.
+
+Pages are indexed in a background thread. Pages modified in the editor are
+re-indexed in the same thread, shortly after they stop changing. They are
+marked as dirty until the document is saved, so that unsaved modifications
+don't outlive the session.
+"""
+
+import collections
+import hashlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+import weakref
+
+import djvu.const
+import djvu.sexpr
+
+from djvusmooth import config
+from djvusmooth.models import text
+
+Hit = collections.namedtuple("Hit", ["page_no", "rect", "text"])
+
+
+def get_search_index_directory():
+    path = config.xdg.save_cache_path("djvusmooth")
+    path = os.path.join(path, "search")
+    try:
+        os.mkdir(path, 0o700)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    return path
+
+
+def _get_stamp(path):
+    st = os.stat(path)
+    return "%d:%d" % (st.st_size, st.st_mtime_ns)
+
+
+def iter_words(page_text):
+    """
+    Yield (rect, text) pairs for words of the page.
+
+    Words split into characters are joined back. Leaves larger than words
+    (e.g. lines) are yielded as a whole.
+    """
+    for node in page_text.get_preorder_nodes():
+        type = node.type
+        if type == djvu.const.TEXT_ZONE_WORD:
+            if node.is_leaf():
+                yield node.rect, node.text
+            else:
+                words = (leaf.text for leaf in node if leaf.is_leaf())
+                yield node.rect, "".join(words)
+        elif node.is_leaf():
+            if type < djvu.const.TEXT_ZONE_WORD:
+                try:
+                    parent_type = node.parent.type
+                except StopIteration:
+                    parent_type = None
+                if parent_type == djvu.const.TEXT_ZONE_WORD:
+                    # Already yielded as a part of the word.
+                    continue
+            yield node.rect, node.text
+
+
+class _TextCallback(text.PageTextCallback):
+    def __init__(self, index, n, model):
+        self._index = index
+        self._n = n
+        self._model = weakref.ref(model)
+
+    def _update(self):
+        self._index.update_page(self._n, self._model())
+
+    def notify_node_change(self, node):
+        self._update()
+
+    def notify_node_children_change(self, node):
+        self._update()
+
+    def notify_tree_change(self, node):
+        self._update()
+
+    def notify_node_select(self, node):
+        pass
+
+    def notify_node_deselect(self, node):
+        pass
+
+
+class SearchIndex(object):
+    """
+    Full-text index of the document at `document_path`, with `n_pages` pages.
+
+    `acquire_data(n)` should return the hidden text of the n-th page as saved
+    in the document. It's called in a worker thread.
+    """
+
+    _commit_interval = 1.0  # seconds
+    _update_delay = 0.2  # seconds
+
+    def __init__(self, document_path, n_pages, acquire_data):
+        self._document_path = os.path.abspath(os.fsdecode(document_path))
+        digest = hashlib.sha1(self._document_path.encode("UTF-8", "surrogateescape"))
+        self._path = os.path.join(
+            get_search_index_directory(), digest.hexdigest() + ".sqlite"
+        )
+        self._n_pages = n_pages
+        self._acquire_data = acquire_data
+        self._queue = queue.Queue()
+        self._condition = threading.Condition()
+        self._n_pending = 0
+        self._n_indexed = 0
+        # page number → (weak reference to the model, time of the last change):
+        self._changed = {}
+        self._closed = False
+        # Models keep only weak references to their callbacks:
+        self._callbacks = weakref.WeakKeyDictionary()
+        self._connection = self._connect()
+        self._setup()
+        self._thread = threading.Thread(target=self._work, name="djvusmooth-search")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self._path, timeout=60)
+        connection.execute("PRAGMA journal_mode = WAL")
+        return connection
+
+    def _setup(self):
+        stamp = _get_stamp(self._document_path)
+        try:
+            [[old_stamp]] = self._connection.execute(
+                "SELECT value FROM meta WHERE key = 'stamp'"
+            )
+        except (sqlite3.DatabaseError, ValueError):
+            old_stamp = None
+        if old_stamp != stamp:
+            self._connection.close()
+            for suffix in "", "-wal", "-shm":
+                try:
+                    os.unlink(self._path + suffix)
+                except OSError:
+                    pass
+            self._connection = self._connect()
+        with self._connection as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS pages "
+                "(page_no INTEGER PRIMARY KEY, dirty INTEGER NOT NULL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS zones "
+                "(id INTEGER PRIMARY KEY, page_no INTEGER NOT NULL, "
+                "x INTEGER, y INTEGER, w INTEGER, h INTEGER, text TEXT NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS zones_page_no ON zones (page_no)"
+            )
+            try:
+                connection.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS zones_fts USING fts5(text)"
+                )
+            except sqlite3.OperationalError:
+                # FTS5 is not available; fall back to sequential scans.
+                self._fts = False
+            else:
+                self._fts = True
+            connection.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('stamp', ?)", (stamp,)
+            )
+            # Unsaved modifications from the previous session:
+            dirty = [
+                page_no
+                for [page_no] in connection.execute(
+                    "SELECT page_no FROM pages WHERE dirty"
+                )
+            ]
+            for page_no in dirty:
+                self._delete_page(connection, page_no)
+            [[self._n_indexed]] = connection.execute("SELECT COUNT(*) FROM pages")
+
+    def _delete_page(self, connection, page_no):
+        if self._fts:
+            connection.execute(
+                "DELETE FROM zones_fts WHERE rowid IN "
+                "(SELECT id FROM zones WHERE page_no = ?)",
+                (page_no,),
+            )
+        connection.execute("DELETE FROM zones WHERE page_no = ?", (page_no,))
+        connection.execute("DELETE FROM pages WHERE page_no = ?", (page_no,))
+
+    def _write_page(self, connection, page_no, words, dirty):
+        self._delete_page(connection, page_no)
+        connection.execute("INSERT INTO pages VALUES (?, ?)", (page_no, int(dirty)))
+        for (x, y, w, h), word in words:
+            cursor = connection.execute(
+                "INSERT INTO zones (page_no, x, y, w, h, text) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (page_no, x, y, w, h, word),
+            )
+            if self._fts:
+                connection.execute(
+                    "INSERT INTO zones_fts (rowid, text) VALUES (?, ?)",
+                    (cursor.lastrowid, word),
+                )
+
+    def _work(self):
+        connection = self._connect()
+        try:
+            self._work_with(connection)
+        finally:
+            connection.close()
+
+    def _work_with(self, connection):
+        indexed = set(
+            page_no for [page_no] in connection.execute("SELECT page_no FROM pages")
+        )
+        todo = collections.deque(n for n in range(self._n_pages) if n not in indexed)
+        last_commit = time.time()
+        while True:
+            try:
+                message = self._queue.get(block=not todo)
+            except queue.Empty:
+                message = None
+            if message is not None:
+                kind, args = message
+                if kind == "close":
+                    connection.commit()
+                    return
+                elif kind == "page":
+                    [page_no] = args
+                    words = self._get_changed_words(page_no)
+                    if words is not None:
+                        self._write_page(connection, page_no, words, dirty=True)
+                        indexed.add(page_no)
+                elif kind == "saved":
+                    [stamp] = args
+                    connection.execute("UPDATE pages SET dirty = 0")
+                    connection.execute(
+                        "INSERT OR REPLACE INTO meta VALUES ('stamp', ?)", (stamp,)
+                    )
+                connection.commit()
+                last_commit = time.time()
+                with self._condition:
+                    self._n_pending -= 1
+                    self._n_indexed = len(indexed)
+                    self._condition.notify_all()
+                continue
+            page_no = todo.popleft()
+            if page_no in indexed:
+                # Already indexed, because it was modified in the meantime.
+                continue
+            try:
+                sexpr = self._acquire_data(page_no)
+            except Exception:
+                # Broken page. It will be retried in the next session.
+                continue
+            words = list(iter_words(text.PageText(page_no, sexpr)))
+            self._write_page(connection, page_no, words, dirty=False)
+            indexed.add(page_no)
+            now = time.time()
+            if not todo or now - last_commit >= self._commit_interval:
+                connection.commit()
+                last_commit = now
+                with self._condition:
+                    self._n_indexed = len(indexed)
+
+    def _get_changed_words(self, page_no):
+        while True:
+            with self._condition:
+                reference, timestamp = self._changed[page_no]
+                delay = timestamp + self._update_delay - time.time()
+                if delay <= 0:
+                    del self._changed[page_no]
+                    break
+            # Wait until the page stops changing:
+            time.sleep(delay)
+        page_text = reference()
+        if page_text is None:
+            return None
+        try:
+            return list(iter_words(page_text))
+        except Exception:
+            # The page was being modified in the meantime.
+            # It's already scheduled for another update.
+            return None
+
+    def _send(self, kind, *args):
+        if self._closed:
+            return
+        with self._condition:
+            self._n_pending += 1
+        self._queue.put((kind, args))
+
+    def get_progress(self):
+        """
+        Return the number of indexed pages and the number of all pages.
+        """
+        return self._n_indexed, self._n_pages
+
+    def is_complete(self):
+        return self._n_indexed >= self._n_pages
+
+    def update_page(self, page_no, page_text):
+        """
+        Schedule re-indexing of the page, using its (possibly modified) model.
+
+        The words are extracted in the worker thread, once the page hasn't
+        changed for a while, so a burst of modifications costs a single update.
+
+        >>> index = _new_test_index()
+        >>> page_text = _CountingPageText(0, None)
+        >>> for i in range(100):
+        ...     page_text.raw_value = _make_test_page_sexpr("version%d" % i)
+        ...     index.update_page(0, page_text)
+        >>> [hit.text for hit in index.search("version99")]
+        ['version99']
+        >>> page_text.n_scans
+        1
+        >>> index.close()
+        """
+        if self._closed:
+            return
+        with self._condition:
+            pending = page_no in self._changed
+            self._changed[page_no] = weakref.ref(page_text), time.time()
+        if not pending:
+            self._send("page", page_no)
+
+    def notify_saved(self):
+        """
+        Acknowledge that the modifications have been saved in the document.
+        """
+        self._send("saved", _get_stamp(self._document_path))
+
+    def attach(self, text_model):
+        """
+        Re-index pages as soon as their models change.
+        """
+
+        def hook(n, model):
+            callback = _TextCallback(self, n, model)
+            self._callbacks[model] = callback
+            model.register_callback(callback)
+
+        text_model.add_page_hook(hook)
+
+    def _wait_for_updates(self):
+        with self._condition:
+            while self._n_pending > 0 and self._thread.is_alive():
+                self._condition.wait(0.1)
+
+    def search(self, query, prefix=False, limit=None):
+        """
+        Return hits for words matching the query, in the page order.
+
+        With FTS5 matching is case-insensitive and token-based, so the query
+        matches whole words (or their beginnings, if `prefix` is true).
+        Otherwise, it matches any substring.
+
+        Every word of the query must match on the page; all the matching words
+        of such pages are returned.
+
+        >>> index = _new_test_index(
+        ...     ["quick brown fox", "quick dog", "lazy brown dog"]
+        ... )
+        >>> [hit[:2] for hit in index.search("brown dog")]
+        [(2, (30, 10, 10, 10)), (2, (50, 10, 10, 10))]
+        >>> [hit.text for hit in index.search("qui", prefix=True)]
+        ['quick', 'quick']
+        >>> [hit.text for hit in index.search("cat dog")]
+        []
+        >>> index.close()
+        """
+        self._wait_for_updates()
+        if limit is None:
+            limit = -1
+        tokens = query.split()
+        if not tokens:
+            return []
+        conditions = []
+        parameters = []
+        for token in tokens:
+            if self._fts:
+                expression = '"%s"' % token.replace('"', '""')
+                if prefix:
+                    expression += " *"
+                conditions += [
+                    "id IN (SELECT rowid FROM zones_fts WHERE zones_fts MATCH ?)"
+                ]
+                parameters += [expression]
+            else:
+                pattern = (
+                    token.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                )
+                conditions += ["text LIKE ? ESCAPE '\\'"]
+                parameters += ["%" + pattern + "%"]
+        sql = "SELECT page_no, x, y, w, h, text FROM zones WHERE (%s)" % (
+            " OR ".join(conditions)
+        )
+        if len(tokens) > 1:
+            # Rows are single words; so look for pages that contain all of them.
+            sql += " AND page_no IN (%s)" % " INTERSECT ".join(
+                "SELECT page_no FROM zones WHERE " + condition
+                for condition in conditions
+            )
+            parameters *= 2
+        sql += " ORDER BY page_no, id LIMIT ?"
+        cursor = self._connection.execute(sql, parameters + [limit])
+        return [
+            Hit(page_no, (x, y, w, h), word) for page_no, x, y, w, h, word in cursor
+        ]
+
+    def close(self):
+        if self._closed:
+            return
+        self._queue.put(("close", ()))
+        self._closed = True
+        self._connection.close()
+
+
+def _make_test_page_sexpr(line):
+    words = [
+        [djvu.sexpr.Symbol("word"), 10 + 20 * i, 10, 20 + 20 * i, 20, word]
+        for i, word in enumerate(line.split())
+    ]
+    return djvu.sexpr.Expression([djvu.sexpr.Symbol("page"), 0, 0, 100, 100] + words)
+
+
+class _CountingPageText(text.PageText):
+    n_scans = 0
+
+    def get_preorder_nodes(self):
+        self.n_scans += 1
+        return text.PageText.get_preorder_nodes(self)
+
+
+def _new_test_index(lines=()):
+    import tempfile
+
+    directory = tempfile.mkdtemp()
+    config.xdg.xdg_cache_home = directory
+    document_path = os.path.join(directory, "document.djvu")
+    with open(document_path, "wb"):
+        pass
+    pages = [_make_test_page_sexpr(line) for line in lines]
+    index = SearchIndex(document_path, len(pages), pages.__getitem__)
+    while not index.is_complete():
+        time.sleep(0.01)
+    return index
+
+
+__all__ = ["SearchIndex", "Hit", "iter_words"]
+
+# vim:ts=4 sts=4 sw=4 et
@@ -0,0 +1,179 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2019 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+"""
+Flattening hidden text of many pages in worker processes.
+
+Every worker opens the document on its own, acquires text of the pages,
+strips it and sends back the original and the flattened s-expressions
+(serialised, as s-expressions can't be pickled).
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+
+import djvu.const
+import djvu.decode
+import djvu.sexpr
+
+from djvusmooth.models import text
+
+_document = None
+
+
+def _init_worker(path):
+    global _document
+    context = djvu.decode.Context()
+    document = context.new_document(djvu.decode.FileURI(path))
+    document.decoding_job.wait()
+    # The context must outlive the document:
+    _document = context, document
+
+
+def _serialise(sexpr):
+    if sexpr is None:
+        return None
+    return str(sexpr)
+
+
+def _deserialise(value):
+    if value is None:
+        return None
+    return djvu.sexpr.Expression.from_string(value)
+
+
+def _flatten_pages(page_nos, zone_type):
+    zone_type = djvu.const.get_text_zone_type(djvu.sexpr.Symbol(zone_type))
+    context, document = _document
+    results = []
+    for n in page_nos:
+        try:
+            page_text = document.pages[n].text
+            page_text.wait()
+            original = page_text.sexpr
+        except djvu.decode.JobFailed:
+            results += [(n, None)]
+            continue
+        model = text.PageText(n, original)
+        model.strip(zone_type)
+        original = _serialise(original)
+        stripped = _serialise(model.raw_value)
+        if stripped == original:
+            # Nothing to flatten.
+            continue
+        results += [(n, (original, stripped))]
+    return results
+
+
+def _get_mp_context():
+    # Forking a process that runs GUI and other threads is not safe.
+    methods = multiprocessing.get_all_start_methods()
+    for method in "forkserver", "spawn":
+        if method in methods:
+            return multiprocessing.get_context(method)
+    return multiprocessing.get_context()
+
+
+class Flattener(object):
+    """
+    Flatten text of pages `page_nos` of the document at `path`, removing zones
+    of the type `zone_type` and smaller ones.
+
+    Call wait() repeatedly until `done` is true; then `results` is a list of
+    (page number, original s-expression, flattened s-expression) tuples for
+    pages that have changed, and `failed` is a list of page numbers that
+    couldn't be processed.
+    """
+
+    def __init__(self, path, page_nos, zone_type, max_workers=None, chunk_size=16):
+        page_nos = list(page_nos)
+        self._n_pages = len(page_nos)
+        self._n_done = 0
+        self._raw_results = []
+        self.failed = []
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        max_workers = max(1, min(max_workers, -(-self._n_pages // chunk_size)))
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=_get_mp_context(),
+            initializer=_init_worker,
+            initargs=(os.fsdecode(path),),
+        )
+        zone_type = str(zone_type)
+        self._futures = {}
+        for i in range(0, self._n_pages, chunk_size):
+            chunk = page_nos[i : i + chunk_size]
+            future = self._executor.submit(_flatten_pages, chunk, zone_type)
+            self._futures[future] = chunk
+
+    @property
+    def n_pages(self):
+        return self._n_pages
+
+    @property
+    def n_done(self):
+        return self._n_done
+
+    @property
+    def done(self):
+        return not self._futures
+
+    def wait(self, timeout=None):
+        """
+        Wait (at most `timeout` seconds) for some of the pages to be processed.
+        """
+        if not self._futures:
+            return
+        finished, pending = concurrent.futures.wait(
+            self._futures,
+            timeout=timeout,
+            return_when=concurrent.futures.FIRST_COMPLETED,
+        )
+        for future in finished:
+            chunk = self._futures.pop(future)
+            self._n_done += len(chunk)
+            try:
+                results = future.result()
+            except Exception:
+                # Probably a broken worker process. These pages will have to be
+                # processed in a usual way.
+                self.failed += chunk
+                continue
+            for n, result in results:
+                if result is None:
+                    self.failed += [n]
+                else:
+                    self._raw_results += [(n, result)]
+
+    @property
+    def results(self):
+        for n, (original, stripped) in sorted(self._raw_results):
+            yield n, _deserialise(original), _deserialise(stripped)
+
+    def cancel(self):
+        for future in self._futures:
+            future.cancel()
+        self._futures = {}
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+__all__ = ["Flattener"]
+
+# vim:ts=4 sts=4 sw=4 et
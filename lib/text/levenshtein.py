@@ -1,6 +1,6 @@
 # encoding=UTF-8
 
-# Copyright © 2008-2015 Jakub Wilk <jwilk@jwilk.net>
+# Copyright © 2008-2019 Jakub Wilk <jwilk@jwilk.net>
 #
 # This file is part of djvusmooth.
 #
@@ -13,85 +13,130 @@
 # FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
 # more details.
 
+"""
+Edit operations transforming one string into another.
 
-class Operation(object):
-    def __init__(self, cost):
-        self.cost = cost
+Only cells of the edit distance matrix near its diagonal are computed: the
+band is widened until it's known to contain an optimal alignment. Only two
+rows of distances are kept at a time; the rest of the band is stored as one
+byte per cell, recording which operation was chosen.
+"""
 
-    def __cmp__(self, other):
-        return cmp(self.cost, other.cost)
+# Operations, in the order of preference (if their costs are equal):
+_DELETE = 0
+_INSERT = 1
+_SUBSTITUTE = 2
 
-    def __repr__(self):
-        return "{cls}(cost={cost})".format(cls=type(self).__name__, cost=self.cost)
+_INITIAL_BAND_WIDTH = 8
 
-    def __add__(self, other):
-        return self.cost + other
 
+def _fill_band(s, t, width):
+    """
+    Compute operations for cells (i, j) such that |i - j| <= width.
 
-class Delete(Operation):
-    pass
-
-
-class Insert(Operation):
-    pass
-
-
-class Substitute(Operation):
-    pass
-
-
-class Drop(Operation):
-    pass
-
-
-class Append(Operation):
-    pass
-
-
-def distance(s, t):
+    Return the distance (or a number larger than width, if the optimal
+    alignment doesn't fit into the band), and the operations: a list of
+    (first column, bytearray) pairs, one per row.
+    """
     len_s = len(s)
     len_t = len(t)
-    d = [[None for j in range(len_t + 1)] for i in range(len_s + 1)]
-    for i in range(len_s + 1):
-        d[i][0] = Drop(i)
-    for j in range(len_t + 1):
-        d[0][j] = Append(j)
+    infinity = len_s + len_t + 1
+    prev_lo = 0
+    prev = list(range(min(len_t, width) + 1))
+    rows = [(0, None)]
     for i in range(1, len_s + 1):
-        for j in range(1, len_t + 1):
-            subst_cost = int(s[i - 1] != t[j - 1])
-            d[i][j] = min(
-                Delete(d[i - 1][j] + 1),
-                Insert(d[i][j - 1] + 1),
-                Substitute(d[i - 1][j - 1] + subst_cost),
-            )
-    i = len_s
-    j = len_t
+        lo = max(0, i - width)
+        hi = min(len_t, i + width)
+        prev_hi = prev_lo + len(prev) - 1
+        row = []
+        ops = bytearray(hi - lo + 1)
+        char = s[i - 1]
+        for j in range(lo, hi + 1):
+            if j == 0:
+                row += [i]
+                continue
+            if prev_lo <= j <= prev_hi:
+                cost = prev[j - prev_lo] + 1
+            else:
+                cost = infinity
+            op = _DELETE
+            if j > lo:
+                insert_cost = row[-1] + 1
+                if insert_cost < cost:
+                    cost = insert_cost
+                    op = _INSERT
+            if prev_lo <= j - 1 <= prev_hi:
+                subst_cost = prev[j - 1 - prev_lo] + (char != t[j - 1])
+                if subst_cost < cost:
+                    cost = subst_cost
+                    op = _SUBSTITUTE
+            row += [cost]
+            ops[j - lo] = op
+        rows += [(lo, ops)]
+        prev = row
+        prev_lo = lo
+    if len_t - prev_lo >= len(prev):
+        return infinity, rows
+    return prev[len_t - prev_lo], rows
+
+
+def distance(s, t):
+    """
+    Return edit operations transforming `s` into `t`, as (i, old, new)
+    tuples, where i is a position in `s`.
+
+    >>> list(distance('kitten', 'sitting'))
+    [(0, 'k', 's'), (4, 'e', 'i'), (6, '', 'g')]
+    >>> list(distance('abc', 'abc'))
+    []
+    >>> list(distance('aa', 'a'))
+    [(1, 'a', '')]
+    >>> list(distance('', 'ab'))
+    [(0, '', 'a'), (0, '', 'b')]
+    >>> list(distance('ab', ''))
+    [(0, 'a', ''), (1, 'b', '')]
+
+    When backtracking through equally cheap alignments, deletions are
+    preferred to insertions, and insertions to substitutions.
+    """
+    # An optimal alignment matches the common prefix character by character:
+    offset = 0
+    limit = min(len(s), len(t))
+    while offset < limit and s[offset] == t[offset]:
+        offset += 1
+    s = s[offset:]
+    t = t[offset:]
+    width = abs(len(s) - len(t)) + _INITIAL_BAND_WIDTH
+    while True:
+        # Cells farther than d from the diagonal can't be on an alignment
+        # of cost d; so if d <= width, the band holds all optimal ones.
+        cost, rows = _fill_band(s, t, width)
+        if cost <= width or width >= max(len(s), len(t)):
+            break
+        width *= 2
+    i = len(s)
+    j = len(t)
     ops = []
     while True:
-        op = d[i][j]
-        if isinstance(op, Delete):
+        if i == 0:
+            ops += ((offset, "", t[jj]) for jj in range(j - 1, -1, -1))
+            break
+        if j == 0:
+            ops += ((offset + ii, s[ii], "") for ii in range(i - 1, -1, -1))
+            break
+        lo, row_ops = rows[i]
+        op = row_ops[j - lo]
+        if op == _DELETE:
             i -= 1
-            ops += ((i, s[i], ""),)
-        elif isinstance(op, Insert):
+            ops += ((offset + i, s[i], ""),)
+        elif op == _INSERT:
             j -= 1
-            ops += ((i, "", t[j]),)
-        elif isinstance(op, Substitute):
+            ops += ((offset + i, "", t[j]),)
+        else:
             i -= 1
             j -= 1
             if s[i] != t[j]:
-                ops += (
-                    (
-                        i,
-                        s[i],
-                        t[j],
-                    ),
-                )
-        elif isinstance(op, Append):
-            ops += ((i, "", t[jj]) for jj in range(j - 1, -1, -1))
-            break
-        elif isinstance(op, Drop):
-            ops += ((ii, s[ii], "") for ii in range(i - 1, -1, -1))
-            break
+                ops += ((offset + i, s[i], t[j]),)
     return reversed(ops)
 
 
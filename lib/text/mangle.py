@@ -14,6 +14,8 @@
 # more details.
 
 
+import difflib
+import hashlib
 import itertools
 
 import djvu.sexpr
@@ -21,20 +23,26 @@ import djvu.const
 
 from djvusmooth.text.levenshtein import distance
 
+# When text of many pages is exported, every page is preceded by a line
+# consisting of this character and the page number:
+PAGE_SEPARATOR = "\f"
 
-def mangle(s, t, input):
-    s = s.decode("UTF-8", "replace")
-    t = t.decode("UTF-8", "replace")
-    if len(input) == 1 and isinstance(input[0], djvu.sexpr.StringExpression):
-        yield t
-        return
-    input = tuple([o.value for o in item] for item in input)
+
+def _decode(s):
+    if isinstance(s, bytes):
+        return s.decode("UTF-8", "replace")
+    return s
+
+
+def _mangle_chars(s, t, input):
+    """
+    Align `s` and `t` character by character, and re-distribute word zones
+    `input` of `s` among words of `t`.
+
+    Text of every zone of `input` must be replaced with its length.
+    """
     j = 0
     current_word = ""
-    for item in input:
-        item[5] = item[5].decode("UTF-8", "replace")
-    for item in input:
-        item[5] = len(item[5])
     input_iter = iter(input)
     input_head = next(input_iter)
     for i, ot, to in distance(s, t):
@@ -84,6 +92,74 @@ def mangle(s, t, input):
     yield input_head[:5] + [current_word]
 
 
+def _get_changed_spans(old_words, new_words):
+    """
+    Return (i1, i2, j1, j2) tuples, such that old_words[i1:i2] should be
+    replaced with new_words[j1:j2], and the other words are unchanged.
+
+    Every span covers at least one old word, whose zone can be re-used.
+    """
+    matcher = difflib.SequenceMatcher(None, old_words, new_words, autojunk=False)
+    spans = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        if i1 == i2:
+            # Insertion: the new words have to take space from a neighbour.
+            if i1 > 0:
+                i1 -= 1
+                j1 -= 1
+            else:
+                i2 += 1
+                j2 += 1
+        if spans and i1 <= spans[-1][1]:
+            p1, p2, q1, q2 = spans.pop()
+            i1, i2, j1, j2 = p1, max(p2, i2), q1, max(q2, j2)
+        spans += [(i1, i2, j1, j2)]
+    return spans
+
+
+def mangle(s, t, input):
+    """
+    Return word zones for the line `t`, which is an edited version of the
+    line `s` with word zones `input`.
+
+    Unchanged words keep their zones. Zones of changed words are
+    re-distributed with character-level alignment.
+    """
+    s = _decode(s)
+    t = _decode(t)
+    if len(input) == 1 and isinstance(input[0], djvu.sexpr.StringExpression):
+        yield t
+        return
+    input = tuple([o.value for o in item] for item in input)
+    old_words = [_decode(item[5]) for item in input]
+    new_words = t.split(" ")
+    if " ".join(old_words) != s:
+        # Words containing spaces? Align the whole line.
+        chars_input = [item[:5] + [len(word)] for item, word in zip(input, old_words)]
+        for item in _mangle_chars(s, t, chars_input):
+            yield item
+        return
+    i = 0
+    for i1, i2, j1, j2 in _get_changed_spans(old_words, new_words):
+        for k in range(i, i1):
+            yield input[k][:5] + [old_words[k]]
+        i = i2
+        if j1 == j2:
+            # The words have been deleted; so have their zones.
+            continue
+        chars_input = [
+            item[:5] + [len(word)] for item, word in zip(input[i1:i2], old_words[i1:i2])
+        ]
+        for item in _mangle_chars(
+            " ".join(old_words[i1:i2]), " ".join(new_words[j1:j2]), chars_input
+        ):
+            yield item
+    for k in range(i, len(input)):
+        yield input[k][:5] + [old_words[k]]
+
+
 def linearize_for_export(expr):
     if expr[0].value == djvu.const.TEXT_ZONE_CHARACTER:
         raise CharacterZoneFound
@@ -120,6 +196,9 @@ def export(sexpr, stream):
 
 
 def import_(sexpr, stdin):
+    # The expression is modified in place below, and it may share structure
+    # with the model's cached or original data:
+    sexpr = djvu.sexpr.Expression.from_string(sexpr.as_string())
     exported = tuple(linearize_for_export(sexpr))
     inputs = tuple(linearize_for_import(sexpr))
     stdin = tuple(line for line in stdin)
@@ -137,6 +216,79 @@ def import_(sexpr, stdin):
     return sexpr
 
 
+def import_changes(sexpr, old_lines, new_lines):
+    """
+    Like import_(), but import only lines that differ between `old_lines`
+    and `new_lines`; other lines of `sexpr` are kept as they are, even if
+    they no longer match `old_lines`.
+    """
+    old_lines = [line.rstrip("\n") for line in old_lines]
+    new_lines = [line.rstrip("\n") for line in new_lines]
+    lines = list(linearize_for_export(sexpr))
+    if not (len(lines) == len(old_lines) == len(new_lines)):
+        raise LengthChanged
+    for n, (old_line, new_line) in enumerate(zip(old_lines, new_lines)):
+        if old_line != new_line:
+            lines[n] = new_line
+    return import_(sexpr, lines)
+
+
+def get_lines_digest(lines):
+    digest = hashlib.sha1()
+    for line in lines:
+        digest.update(line.rstrip("\n").encode("UTF-8", "surrogateescape"))
+        digest.update(b"\n")
+    return digest.digest()
+
+
+def export_pages(pages, stream):
+    """
+    Export text of many pages, given as (page number, s-expression) pairs.
+
+    Pages with character zones are skipped. Return digests of the exported
+    text, indexed by page numbers.
+    """
+    digests = {}
+    for n, sexpr in pages:
+        if sexpr:
+            try:
+                lines = list(linearize_for_export(sexpr))
+            except CharacterZoneFound:
+                continue
+        else:
+            lines = []
+        print("%s%d" % (PAGE_SEPARATOR, n + 1), file=stream)
+        for line in lines:
+            print(line, file=stream)
+        digests[n] = get_lines_digest(lines)
+    return digests
+
+
+def split_pages(stream):
+    """
+    Split text exported with export_pages() into (page number, lines) pairs.
+    """
+    n = None
+    lines = []
+    for line in stream:
+        if line.startswith(PAGE_SEPARATOR):
+            if n is not None:
+                yield n, lines
+            try:
+                n = int(line[len(PAGE_SEPARATOR) :]) - 1
+            except ValueError:
+                raise MalformedPageSeparator(
+                    "malformed page separator: {0!r}".format(line)
+                )
+            lines = []
+        elif n is None:
+            raise MalformedPageSeparator("text before the first page separator")
+        else:
+            lines += [line]
+    if n is not None:
+        yield n, lines
+
+
 class NothingChanged(Exception):
     pass
 
@@ -149,6 +301,21 @@ class CharacterZoneFound(Exception):
     pass
 
 
-__all__ = ["import_", "export", "NothingChanged", "CharacterZoneFound", "LengthChanged"]
+class MalformedPageSeparator(ValueError):
+    pass
+
+
+__all__ = [
+    "import_",
+    "import_changes",
+    "export",
+    "export_pages",
+    "split_pages",
+    "get_lines_digest",
+    "NothingChanged",
+    "CharacterZoneFound",
+    "LengthChanged",
+    "MalformedPageSeparator",
+]
 
 # vim:ts=4 sts=4 sw=4 et